@@ -0,0 +1,367 @@
+"""
+Measure the speed/accuracy trade-off of the solver on a fixed evaluation set.
+
+Usage:
+
+    python -m flatten_torch.bench --checkpoint diffusion_model.pt \\
+        --samplers ddpm,ddim,dpm2m --steps 16,128 --candidates 16,128 \\
+        --iters 100,1000
+
+To compare against the mixture density proposal model, add "mdn" to
+--samplers and pass --mdn_checkpoint mdn_model.pt.
+"""
+
+import argparse
+import itertools
+import json
+import os
+from dataclasses import asdict, dataclass, fields
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from .camera import Camera, euler_rotation
+from .data import Batch, corners_on_zplane
+from .solver import (
+    DIFFUSION_SAMPLERS,
+    SAMPLERS,
+    corner_errors,
+    create_sampling_diffusion,
+    load_diffusion_config,
+    load_diffusion_predictor,
+    load_mixture_predictor,
+    optimize_for_inference,
+    solve,
+    synchronized_time,
+)
+
+PERCENTILES = (50, 90, 99)
+
+
+@dataclass
+class BenchConfig:
+    sampler: str
+    steps: int
+    num_candidates: int
+    iters: int
+    dedup_radius: Optional[float] = None
+    top_k: Optional[int] = None
+    halving_rounds: int = 1
+    guidance_scale: Optional[float] = None
+    early_exit_tol: Optional[float] = None
+    early_exit_loss: Optional[float] = None
+
+
+@dataclass
+class BenchResult:
+    config: BenchConfig
+    error_percentiles: Dict[int, float]  # max corner error percentiles
+    success_rate: float
+    latency_ms: float  # median wall-clock time to solve one target
+    throughput: float  # targets solved per second in batched mode
+    model_evals: Optional[float] = None  # mean network evaluations per candidate
+
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, obj: Dict[str, Any]) -> "BenchResult":
+        obj = dict(obj)
+        obj["config"] = BenchConfig(**obj["config"])
+        obj["error_percentiles"] = {
+            int(k): v for k, v in obj["error_percentiles"].items()
+        }
+        return cls(**obj)
+
+
+def eval_batch(
+    num_samples: int = 2048,
+    hard_frac: float = 0.25,
+    seed: int = 0,
+    margin: float = 0.1,
+    z_near: float = 0.1,
+) -> Batch:
+    """
+    Deterministically create an evaluation set from the training distribution.
+
+    A hard_frac fraction of the samples are the hardest out of a larger pool,
+    where hardness means having a corner close to the edge of the valid image
+    region or close to the near clipping plane.
+    """
+    gen = torch.Generator().manual_seed(seed)
+    num_hard = int(num_samples * hard_frac)
+    easy = Batch.sample_batch(
+        num_samples - num_hard, generator=gen, margin=margin, z_near=z_near
+    )
+    if num_hard == 0:
+        return easy
+    pool = Batch.sample_batch(
+        num_hard * 20, generator=gen, margin=margin, z_near=z_near
+    )
+    proj = pool.proj_corners
+    edge_dist = (
+        torch.minimum(proj + margin, 1 + margin - proj).flatten(1).min(-1).values
+    )
+    camera = Camera(
+        rotation=euler_rotation(pool.rotation),
+        translation=pool.translation,
+        post_translation=pool.post_translation,
+    )
+    z = camera.project(corners_on_zplane(pool.origin, pool.size)).z
+    z_dist = (-z[..., 0] - z_near).min(-1).values
+    hardness = -torch.minimum(edge_dist, z_dist)
+    hard = pool[hardness.topk(num_hard).indices]
+    return easy.cat(hard)
+
+
+def load_eval_batch(path: Optional[str] = None, **kwargs) -> Batch:
+    """
+    Load a cached evaluation set, or create it with eval_batch() and save it
+    to path if the file does not exist yet.
+    """
+    if path is not None and os.path.exists(path):
+        obj = torch.load(path, map_location="cpu")
+        return Batch(**obj)
+    batch = eval_batch(**kwargs)
+    if path is not None:
+        torch.save({f.name: getattr(batch, f.name) for f in fields(Batch)}, path)
+    return batch
+
+
+def bench_config(
+    config: BenchConfig,
+    batch: Batch,
+    model: Optional[nn.Module],
+    diffusion_config: Optional[Dict[str, Any]] = None,
+    lr: float = 0.001,
+    success_thresh: float = 1e-3,
+    max_rows: int = 65536,
+    latency_trials: int = 5,
+) -> BenchResult:
+    """
+    Solve every target in batch with one solver configuration.
+
+    :param diffusion_config: the config the diffusion model was trained with.
+    :param success_thresh: the largest max corner error counted as a success.
+    :param max_rows: the maximum number of candidates to refine at once.
+    :param latency_trials: the number of single-target solves to time.
+    """
+    diffusion = None
+    if config.sampler in DIFFUSION_SAMPLERS:
+        diffusion = create_sampling_diffusion(config.steps, config=diffusion_config)
+
+    def run(targets: torch.Tensor) -> torch.Tensor:
+        solution = solve(
+            targets,
+            model=model,
+            diffusion=diffusion,
+            sampler=config.sampler,
+            num_candidates=config.num_candidates,
+            iters=config.iters,
+            lr=lr,
+            dedup_radius=config.dedup_radius,
+            top_k=config.top_k,
+            halving_rounds=config.halving_rounds,
+            guidance_scale=config.guidance_scale,
+            early_exit_tol=config.early_exit_tol,
+            early_exit_loss=config.early_exit_loss,
+        )
+        return corner_errors(solution.prediction, targets)
+
+    targets = batch.proj_corners
+    chunk_size = max(1, max_rows // config.num_candidates)
+    errors = []
+    counter = _EvalCounter()
+    hook = None if model is None else model.register_forward_hook(counter)
+    start = synchronized_time(targets.device)
+    for i in range(0, len(targets), chunk_size):
+        errors.append(run(targets[i : i + chunk_size]))
+    elapsed = synchronized_time(targets.device) - start
+    if hook is not None:
+        hook.remove()
+    errors = torch.cat(errors).cpu().numpy()
+
+    latencies = []
+    for i in range(min(latency_trials, len(targets))):
+        start = synchronized_time(targets.device)
+        run(targets[i : i + 1])
+        latencies.append(synchronized_time(targets.device) - start)
+
+    return BenchResult(
+        config=config,
+        error_percentiles={p: float(np.percentile(errors, p)) for p in PERCENTILES},
+        success_rate=float((errors < success_thresh).mean()),
+        latency_ms=float(np.median(latencies) * 1000),
+        throughput=len(targets) / elapsed,
+        model_evals=counter.rows / (len(targets) * config.num_candidates),
+    )
+
+
+def iterate_configs(
+    samplers: List[str],
+    steps: List[int],
+    candidates: List[int],
+    iters: List[int],
+    dedup_radius: Optional[float] = None,
+    top_k: Optional[int] = None,
+    halving_rounds: int = 1,
+    guidance_scale: Optional[float] = None,
+    early_exit_tol: Optional[float] = None,
+    early_exit_loss: Optional[float] = None,
+) -> Iterator[BenchConfig]:
+    for sampler, num_steps, num_candidates, num_iters in itertools.product(
+        samplers, steps, candidates, iters
+    ):
+        if sampler in ("prior", "mdn") and num_steps != steps[0]:
+            # Sampling steps only affect the diffusion samplers.
+            continue
+        yield BenchConfig(
+            sampler=sampler,
+            steps=num_steps,
+            num_candidates=num_candidates,
+            iters=num_iters,
+            dedup_radius=dedup_radius,
+            top_k=top_k,
+            halving_rounds=halving_rounds,
+            guidance_scale=guidance_scale,
+            early_exit_tol=early_exit_tol,
+            early_exit_loss=early_exit_loss,
+        )
+
+
+def format_result(result: BenchResult) -> str:
+    c = result.config
+    errs = " ".join(f"p{p}={v:.02e}" for p, v in result.error_percentiles.items())
+    return (
+        f"sampler={c.sampler} steps={c.steps} candidates={c.num_candidates}"
+        f" iters={c.iters} dedup={c.dedup_radius} top_k={c.top_k}"
+        f" halving={c.halving_rounds} guidance={c.guidance_scale}"
+        f" early_exit={c.early_exit_tol},{c.early_exit_loss}:"
+        f" {errs} success={result.success_rate:.04f}"
+        f" latency={result.latency_ms:.01f}ms throughput={result.throughput:.02f}/s"
+        f" evals={result.model_evals}"
+    )
+
+
+class _EvalCounter:
+    """
+    A forward hook which counts the rows passed through a model.
+    """
+
+    def __init__(self):
+        self.rows = 0
+
+    def __call__(self, module: nn.Module, inputs: Tuple[Any, ...], output: Any):
+        self.rows += len(inputs[0])
+
+
+def _int_list(s: str) -> List[int]:
+    return [int(x) for x in s.split(",")]
+
+
+def add_bench_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--checkpoint", type=str, default=None)
+    # Off by default to match the weights brute_force.py deploys.
+    parser.add_argument("--use_ema", action="store_true")
+    parser.add_argument("--mdn_checkpoint", type=str, default=None)
+    parser.add_argument("--fuse", action="store_true")
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--eval_set", type=str, default="eval_set.pt")
+    parser.add_argument("--num_samples", type=int, default=2048)
+    parser.add_argument("--samplers", type=str, default="ddpm")
+    parser.add_argument("--steps", type=_int_list, default=[128])
+    parser.add_argument("--candidates", type=_int_list, default=[128])
+    parser.add_argument("--iters", type=_int_list, default=[1000])
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--dedup_radius", type=float, default=None)
+    parser.add_argument("--top_k", type=int, default=None)
+    parser.add_argument("--halving_rounds", type=int, default=1)
+    parser.add_argument("--guidance_scale", type=float, default=None)
+    parser.add_argument("--early_exit_tol", type=float, default=None)
+    parser.add_argument("--early_exit_loss", type=float, default=None)
+    parser.add_argument("--success_thresh", type=float, default=1e-3)
+    parser.add_argument("--max_rows", type=int, default=65536)
+    parser.add_argument("--latency_trials", type=int, default=5)
+
+
+def run_bench(args: argparse.Namespace) -> List[BenchResult]:
+    """
+    Run every configuration described by arguments from add_bench_args().
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    samplers = args.samplers.split(",")
+    for sampler in samplers:
+        assert sampler in SAMPLERS, f"unknown sampler: {sampler}"
+    models = dict(prior=None)
+    diffusion_config = None
+    if any(sampler in DIFFUSION_SAMPLERS for sampler in samplers):
+        assert args.checkpoint is not None, "diffusion samplers need --checkpoint"
+        diffusion_model = load_diffusion_predictor(
+            args.checkpoint, device=device, use_ema=args.use_ema
+        )
+        if args.fuse or args.quantize:
+            diffusion_model = optimize_for_inference(
+                diffusion_model, quantize=args.quantize
+            )
+        models.update({sampler: diffusion_model for sampler in DIFFUSION_SAMPLERS})
+        diffusion_config = load_diffusion_config(args.checkpoint)
+    if "mdn" in samplers:
+        assert args.mdn_checkpoint is not None, "mdn sampler needs --mdn_checkpoint"
+        models["mdn"] = load_mixture_predictor(args.mdn_checkpoint, device=device)
+
+    batch = load_eval_batch(args.eval_set, num_samples=args.num_samples).to(device)
+    print(f"evaluating on {len(batch)} targets")
+
+    results = []
+    for config in iterate_configs(
+        samplers,
+        args.steps,
+        args.candidates,
+        args.iters,
+        dedup_radius=args.dedup_radius,
+        top_k=args.top_k,
+        halving_rounds=args.halving_rounds,
+        guidance_scale=args.guidance_scale,
+        early_exit_tol=args.early_exit_tol,
+        early_exit_loss=args.early_exit_loss,
+    ):
+        result = bench_config(
+            config,
+            batch,
+            models[config.sampler],
+            diffusion_config=diffusion_config,
+            lr=args.lr,
+            success_thresh=args.success_thresh,
+            max_rows=args.max_rows,
+            latency_trials=args.latency_trials,
+        )
+        print(format_result(result))
+        results.append(result)
+    return results
+
+
+def save_results(path: str, results: List[BenchResult]):
+    with open(path, "w") as f:
+        json.dump([r.to_dict() for r in results], f, indent=2)
+
+
+def load_results(path: str) -> List[BenchResult]:
+    with open(path, "r") as f:
+        return [BenchResult.from_dict(x) for x in json.load(f)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_bench_args(parser)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    results = run_bench(args)
+    if args.output is not None:
+        save_results(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
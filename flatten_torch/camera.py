@@ -70,3 +70,17 @@ def euler_rotation(xyz: torch.Tensor) -> torch.Tensor:
     )
 
     return torch.bmm(rot_z, torch.bmm(rot_y, rot_x))
+
+
+def rotation_to_euler(rotation: torch.Tensor) -> torch.Tensor:
+    """
+    Invert euler_rotation().
+
+    :param rotation: an [N x 3 x 3] batch of rotation matrices.
+    :return: an [N x 3] batch of Euler angles, with the y angle in
+             [-pi/2, pi/2].
+    """
+    theta_y = torch.asin((-rotation[:, 2, 0]).clamp(-1, 1))
+    theta_x = torch.atan2(rotation[:, 2, 1], rotation[:, 2, 2])
+    theta_z = torch.atan2(rotation[:, 1, 0], rotation[:, 0, 0])
+    return torch.stack([theta_x, theta_y, theta_z], dim=1)
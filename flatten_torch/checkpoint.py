@@ -0,0 +1,118 @@
+"""
+Weights-only inference checkpoints that can be memory-mapped.
+
+Training checkpoints hold the optimizer state and both sets of weights in a
+pickle, all of which torch.load() has to deserialize. An inference
+checkpoint holds a single state dict in the version 2 format from
+weights.py, stored as float32 with every tensor aligned, and the diffusion
+config (if any) in the header metadata.
+
+load_inference_checkpoint() maps the file copy-on-write and wraps each
+tensor around the mapping with torch.frombuffer(), so loading reads no
+tensor data up front, and forked or separately started workers share the
+same pages through the page cache.
+"""
+
+import mmap
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .weights import is_weight_file, read_index, read_weights, write_weights
+
+# Checkpoint entries, besides the weights, that are needed for inference.
+METADATA_KEYS = ("diffusion_config", "model_config")
+
+
+def save_inference_checkpoint(
+    path: str,
+    state_dict: Dict[str, torch.Tensor],
+    diffusion_config: Optional[Dict[str, Any]] = None,
+    model_config: Optional[Dict[str, Any]] = None,
+):
+    """
+    Write a state dict, and optionally its diffusion and model configs, to
+    path.
+    """
+    arrays = {k: v.detach().float().cpu().numpy() for k, v in state_dict.items()}
+    metadata = dict(diffusion_config=diffusion_config, model_config=model_config)
+    with open(path, "wb") as f:
+        write_weights(f, arrays, dtype="float32", metadata=metadata)
+
+
+def is_inference_checkpoint(path: str) -> bool:
+    return is_weight_file(path)
+
+
+def load_inference_checkpoint(
+    path: str,
+) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    """
+    Map an inference checkpoint into memory.
+
+    Aligned float32 tensors are views of the mapping rather than copies.
+    The mapping is private, so writes to the tensors never reach the file.
+    Tensors stored in other dtypes are dequantized into regular memory.
+
+    :return: a tuple (state_dict, metadata).
+    """
+    infos, data_start, metadata = read_index(path)
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    state_dict = {}
+    copied = None
+    for info in infos:
+        start = data_start + info["offset"]
+        if info["dtype"] != "float32" or start % 4:
+            if copied is None:
+                copied = read_weights(path)
+            state_dict[info["name"]] = torch.from_numpy(np.array(copied[info["name"]]))
+            continue
+        shape = tuple(info["shape"])
+        count = int(np.prod(shape))
+        if count == 0:
+            state_dict[info["name"]] = torch.zeros(shape)
+            continue
+        # The tensors keep a reference to the mapping, keeping it open.
+        state_dict[info["name"]] = torch.frombuffer(
+            buf, dtype=torch.float32, count=count, offset=start
+        ).view(shape)
+    return state_dict, metadata
+
+
+def load_checkpoint(
+    path: str, device: torch.device, use_ema: bool = True
+) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    """
+    Read the weights from either a training checkpoint or an inference
+    checkpoint.
+
+    :param use_ema: for training checkpoints, load the EMA weights rather
+                    than the raw model weights. Inference checkpoints only
+                    hold one set of weights.
+    :return: a tuple (state_dict, metadata), where metadata may include a
+             diffusion_config and a model_config.
+    """
+    if is_inference_checkpoint(path):
+        return load_inference_checkpoint(path)
+    with open(path, "rb") as f:
+        obj = torch.load(f, map_location=device)
+    metadata = {k: obj[k] for k in METADATA_KEYS if obj.get(k) is not None}
+    return obj["ema" if use_ema else "model"], metadata
+
+
+def load_model_state(
+    model: torch.nn.Module, state_dict: Dict[str, torch.Tensor], device: torch.device
+):
+    """
+    Load weights from load_checkpoint() into a model.
+
+    On the CPU, the model's parameters are replaced by the given tensors
+    instead of being copied into, so mapped tensors stay mapped.
+    """
+    if torch.device(device).type == "cpu":
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        model.load_state_dict(state_dict)
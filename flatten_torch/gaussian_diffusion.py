@@ -29,11 +29,13 @@ from typing import Any, Dict, Iterable, Optional, Sequence, Union
 
 import numpy as np
 import torch as th
-import yaml
 
 
 def diffusion_from_config(config: Union[str, Dict[str, Any]]) -> "GaussianDiffusion":
     if isinstance(config, str):
+        # Lazy import so that we only depend on yaml when loading config files.
+        import yaml
+
         with open(config, "rb") as f:
             obj = yaml.load(f, Loader=yaml.SafeLoader)
         return diffusion_from_config(obj)
@@ -510,6 +512,7 @@ class GaussianDiffusion:
         denoised_fn=None,
         cond_fn=None,
         model_kwargs=None,
+        noise=None,
     ):
         """
         Sample x_{t-1} from the model at the given timestep.
@@ -524,6 +527,8 @@ class GaussianDiffusion:
                         similarly to the model.
         :param model_kwargs: if not None, a dict of extra keyword arguments to
             pass to the model. This can be used for conditioning.
+        :param noise: if specified, the Gaussian noise to sample with instead
+                      of drawing new noise.
         :return: a dict containing the following keys:
                  - 'sample': a random sample from the model.
                  - 'pred_xstart': a prediction of x_0.
@@ -536,7 +541,8 @@ class GaussianDiffusion:
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
         )
-        noise = th.randn_like(x)
+        if noise is None:
+            noise = th.randn_like(x)
         nonzero_mask = (
             (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
         )  # no noise when t == 0
@@ -579,21 +585,20 @@ class GaussianDiffusion:
         :param progress: if True, show a tqdm progress bar.
         :return: a non-differentiable batch of samples.
         """
-        final = None
-        for sample in self.p_sample_loop_progressive(
+        return self._final_sample_loop(
+            self.p_sample,
             model,
             shape,
             noise=noise,
+            device=device,
+            progress=progress,
+            temp=temp,
+            draw_noise=True,
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
             cond_fn=cond_fn,
             model_kwargs=model_kwargs,
-            device=device,
-            progress=progress,
-            temp=temp,
-        ):
-            final = sample
-        return final["sample"]
+        )
 
     def p_sample_loop_progressive(
         self,
@@ -656,6 +661,7 @@ class GaussianDiffusion:
         cond_fn=None,
         model_kwargs=None,
         eta=0.0,
+        noise=None,
     ):
         """
         Sample x_{t-1} from the model using DDIM.
@@ -685,7 +691,8 @@ class GaussianDiffusion:
             * th.sqrt(1 - alpha_bar / alpha_bar_prev)
         )
         # Equation 12.
-        noise = th.randn_like(x)
+        if noise is None:
+            noise = th.randn_like(x)
         mean_pred = (
             out["pred_xstart"] * th.sqrt(alpha_bar_prev)
             + th.sqrt(1 - alpha_bar_prev - sigma**2) * eps
@@ -756,22 +763,72 @@ class GaussianDiffusion:
 
         Same usage as p_sample_loop().
         """
-        final = None
-        for sample in self.ddim_sample_loop_progressive(
+        return self._final_sample_loop(
+            self.ddim_sample,
             model,
             shape,
             noise=noise,
+            device=device,
+            progress=progress,
+            temp=temp,
+            # With eta=0, DDIM multiplies its noise by zero, so skip drawing it.
+            draw_noise=eta != 0,
             clip_denoised=clip_denoised,
             denoised_fn=denoised_fn,
             cond_fn=cond_fn,
             model_kwargs=model_kwargs,
-            device=device,
-            progress=progress,
             eta=eta,
-            temp=temp,
-        ):
-            final = sample
-        return final["sample"]
+        )
+
+    def _final_sample_loop(
+        self,
+        step_fn,
+        model,
+        shape,
+        noise=None,
+        device=None,
+        progress=False,
+        temp=1.0,
+        draw_noise=True,
+        **step_kwargs,
+    ):
+        """
+        Run a sampling loop and only return the final sample.
+
+        This gives the same samples as the corresponding progressive loop,
+        but reuses one timestep buffer and one noise buffer for every step,
+        and only unscales the channels of the final sample.
+
+        :param step_fn: p_sample() or ddim_sample().
+        :param draw_noise: if False, pass zeros as the per-step noise instead
+                           of sampling it, which leaves the RNG untouched.
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device) * temp
+        indices = list(range(self.num_timesteps))[::-1]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        t = th.empty(shape[0], dtype=th.long, device=device)
+        step_noise = th.zeros_like(img)
+        with th.no_grad():
+            for i in indices:
+                t.fill_(i)
+                if draw_noise:
+                    # The model never uses the RNG, so drawing noise before
+                    # the model call matches the order of the step functions.
+                    step_noise.normal_()
+                img = step_fn(model, img, t, noise=step_noise, **step_kwargs)["sample"]
+        return self.unscale_channels(img)
 
     def ddim_sample_loop_progressive(
         self,
@@ -824,6 +881,368 @@ class GaussianDiffusion:
                 yield self.unscale_out_dict(out)
                 img = out["sample"]
 
+    def ddim_sample_loop_adaptive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=False,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        temp=1.0,
+        tol=1e-3,
+        patience=2,
+        converged_fn=None,
+    ):
+        """
+        Generate samples with deterministic DDIM, freezing each row once its
+        x_start prediction stops changing.
+
+        A frozen row's sample is its latest x_start prediction, which is
+        where deterministic DDIM converges to anyway. Frozen rows are removed
+        from the batch, and the loop ends early once every row is frozen.
+
+        Same usage as p_sample_loop(), with extra arguments:
+
+        :param tol: the largest per-row L2 change in the x_start prediction
+                    between consecutive steps that counts as stable.
+        :param patience: the number of consecutive stable steps after which
+                         a row is frozen.
+        :param converged_fn: if not None, a function called with the
+                             unscaled x_start predictions of the active rows
+                             and their [M] row indices, which returns an [M]
+                             boolean mask of rows to freeze right away.
+        :return: a dict with keys:
+                 - 'sample': the non-differentiable batch of samples.
+                 - 'num_steps': an [N] tensor with the number of model
+                                evaluations made for each row.
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device) * temp
+        model_kwargs = dict(model_kwargs or {})
+        indices = list(range(self.num_timesteps))[::-1]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        batch_size = shape[0]
+        result = th.empty_like(img)
+        num_steps = th.zeros(batch_size, dtype=th.long, device=device)
+        active = th.arange(batch_size, device=device)
+        stable = th.zeros(batch_size, dtype=th.long, device=device)
+        zeros = th.zeros_like(img)
+        prev_xstart = None
+        with th.no_grad():
+            for i in indices:
+                t = th.full((len(active),), i, dtype=th.long, device=device)
+                out = self.ddim_sample(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                    noise=zeros[: len(active)],
+                )
+                num_steps[active] += 1
+                pred_xstart = out["pred_xstart"]
+                if i == 0:
+                    result[active] = out["sample"]
+                    break
+
+                if prev_xstart is not None:
+                    change = (pred_xstart - prev_xstart).flatten(1).norm(dim=-1)
+                    stable = th.where(change < tol, stable + 1, th.zeros_like(stable))
+                done = stable >= patience
+                if converged_fn is not None:
+                    done = done | converged_fn(
+                        self.unscale_channels(pred_xstart), active
+                    )
+                img = out["sample"]
+                prev_xstart = pred_xstart
+                if done.any():
+                    result[active[done]] = pred_xstart[done]
+                    keep = ~done
+                    if not keep.any():
+                        break
+                    active, img, prev_xstart, stable = (
+                        active[keep],
+                        img[keep],
+                        prev_xstart[keep],
+                        stable[keep],
+                    )
+                    model_kwargs = {
+                        k: (
+                            v[keep]
+                            if isinstance(v, th.Tensor) and len(v) == len(keep)
+                            else v
+                        )
+                        for k, v in model_kwargs.items()
+                    }
+        return {"sample": self.unscale_channels(result), "num_steps": num_steps}
+
+    def _predict_xstart(
+        self,
+        model,
+        x,
+        t,
+        clip_denoised=False,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+    ):
+        """
+        Get the (possibly guided) x_start prediction used by the ODE samplers.
+        """
+        out = self.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        if cond_fn is not None:
+            out = self.condition_score(cond_fn, out, x, t, model_kwargs=model_kwargs)
+        return out["pred_xstart"]
+
+    def dpm_solver_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=False,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        temp=1.0,
+    ):
+        """
+        Generate samples from the model using multistep DPM-Solver++.
+
+        Same usage as p_sample_loop(), plus an order argument which selects
+        DPM-Solver++(2M) or DPM-Solver++(3M).
+        """
+        final = None
+        for sample in self.dpm_solver_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            order=order,
+            temp=temp,
+        ):
+            final = sample
+        return final["sample"]
+
+    def dpm_solver_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=False,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        order=2,
+        temp=1.0,
+    ):
+        """
+        Use multistep DPM-Solver++ (Lu et al., 2022) to sample from the model
+        and yield intermediate samples from each timestep.
+
+        Each step makes one model evaluation and solves the probability flow
+        ODE in terms of the data prediction, reusing the x_start predictions
+        of the previous order - 1 steps. The first steps and the final step
+        fall back to lower orders, which keeps them stable.
+
+        Same usage as p_sample_loop_progressive().
+        """
+        assert order in (1, 2, 3), "DPM-Solver++ only supports orders 1, 2 and 3"
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device) * temp
+        indices = list(range(self.num_timesteps))[::-1]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        prev_xstarts = []
+        prev_hs = []
+        for i in indices:
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                pred_xstart = self._predict_xstart(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    cond_fn=cond_fn,
+                    model_kwargs=model_kwargs,
+                )
+                alpha, sigma = _alpha_sigma(self.alphas_cumprod[i])
+                alpha_next, sigma_next = _alpha_sigma(self.alphas_cumprod_prev[i])
+
+                # The final step to sigma=0 has an infinite step size in
+                # log-SNR, where only the first-order update is defined.
+                step_order = min(order, len(prev_xstarts) + 1)
+                if sigma_next == 0:
+                    img = pred_xstart
+                    step_order = 1
+                else:
+                    h = math.log(alpha_next / sigma_next) - math.log(alpha / sigma)
+                    phi_1 = math.expm1(-h)
+                    img = (sigma_next / sigma) * img - alpha_next * phi_1 * pred_xstart
+                    if step_order == 2:
+                        r0 = prev_hs[-1] / h
+                        d1 = (pred_xstart - prev_xstarts[-1]) / r0
+                        img = img - 0.5 * alpha_next * phi_1 * d1
+                    elif step_order == 3:
+                        r0 = prev_hs[-1] / h
+                        r1 = prev_hs[-2] / h
+                        d1_0 = (pred_xstart - prev_xstarts[-1]) / r0
+                        d1_1 = (prev_xstarts[-1] - prev_xstarts[-2]) / r1
+                        d1 = d1_0 + (r0 / (r0 + r1)) * (d1_0 - d1_1)
+                        d2 = (d1_0 - d1_1) / (r0 + r1)
+                        phi_2 = phi_1 / h + 1
+                        phi_3 = phi_2 / h - 0.5
+                        img = img + alpha_next * phi_2 * d1 - alpha_next * phi_3 * d2
+                    prev_hs = (prev_hs + [h])[-2:]
+                prev_xstarts = (prev_xstarts + [pred_xstart])[-2:]
+                out = {"sample": img, "pred_xstart": pred_xstart}
+                yield self.unscale_out_dict(out)
+
+    def heun_sample_loop(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=False,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        temp=1.0,
+    ):
+        """
+        Generate samples from the model using Heun's second-order method.
+
+        Same usage as p_sample_loop().
+        """
+        final = None
+        for sample in self.heun_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            temp=temp,
+        ):
+            final = sample
+        return final["sample"]
+
+    def heun_sample_loop_progressive(
+        self,
+        model,
+        shape,
+        noise=None,
+        clip_denoised=False,
+        denoised_fn=None,
+        cond_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        temp=1.0,
+    ):
+        """
+        Use Heun's method (Karras et al., 2022) on the probability flow ODE to
+        sample from the model, yielding intermediate samples from each
+        timestep.
+
+        The ODE is solved in the variance-exploding parameterization
+        x / sqrt(alpha_bar), where the noise level is
+        sqrt((1 - alpha_bar) / alpha_bar). Every step except the last one
+        makes two model evaluations.
+
+        Same usage as p_sample_loop_progressive().
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device) * temp
+        indices = list(range(self.num_timesteps))[::-1]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        xstart_kwargs = dict(
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            cond_fn=cond_fn,
+            model_kwargs=model_kwargs,
+        )
+        for i in indices:
+            t = th.tensor([i] * shape[0], device=device)
+            with th.no_grad():
+                alpha, sigma = _alpha_sigma(self.alphas_cumprod[i])
+                alpha_next, sigma_next = _alpha_sigma(self.alphas_cumprod_prev[i])
+                pred_xstart = self._predict_xstart(model, img, t, **xstart_kwargs)
+                # In the variance-exploding parameterization, the derivative
+                # of the signal with respect to the noise level is eps.
+                eps = (img - alpha * pred_xstart) / sigma
+                step = sigma_next / alpha_next - sigma / alpha
+                ve_next = img / alpha + step * eps
+                if sigma_next > 0:
+                    pred_xstart_next = self._predict_xstart(
+                        model, ve_next * alpha_next, t - 1, **xstart_kwargs
+                    )
+                    eps_next = (ve_next - pred_xstart_next) * (alpha_next / sigma_next)
+                    ve_next = img / alpha + step * (eps + eps_next) / 2
+                img = ve_next * alpha_next
+                out = {"sample": img, "pred_xstart": pred_xstart}
+                yield self.unscale_out_dict(out)
+
     def _vb_terms_bpd(
         self, model, x_start, x_t, t, clip_denoised=False, model_kwargs=None
     ):
@@ -1033,6 +1452,80 @@ class GaussianDiffusion:
             "mse": mse,
         }
 
+    def calc_bpd_loop_batched(
+        self,
+        model,
+        x_start,
+        clip_denoised=False,
+        model_kwargs=None,
+        max_batch_size=65536,
+    ):
+        """
+        Compute the same quantities as calc_bpd_loop(), but evaluate many
+        timesteps per model call by folding them into the batch dimension.
+
+        The noise is sampled differently than in calc_bpd_loop(), so results
+        match it in distribution rather than exactly.
+
+        :param max_batch_size: the maximum number of rows to pass to the model
+                               at once. At least one timestep is always
+                               evaluated per call.
+        :return: a dict with the same keys and shapes as calc_bpd_loop().
+        """
+        device = x_start.device
+        batch_size = x_start.shape[0]
+        if model_kwargs is None:
+            model_kwargs = {}
+
+        timesteps = list(range(self.num_timesteps))[::-1]
+        chunk_size = max(1, max_batch_size // batch_size)
+
+        vb = []
+        xstart_mse = []
+        mse = []
+        for start in range(0, len(timesteps), chunk_size):
+            ts = timesteps[start : start + chunk_size]
+            num_ts = len(ts)
+            t_batch = th.tensor(ts, device=device).repeat_interleave(batch_size)
+            x_rep = _repeat_batch(x_start, num_ts)
+            kwargs_rep = {
+                k: (_repeat_batch(v, num_ts) if isinstance(v, th.Tensor) else v)
+                for k, v in model_kwargs.items()
+            }
+            noise = th.randn_like(x_rep)
+            x_t = self.q_sample(x_start=x_rep, t=t_batch, noise=noise)
+            with th.no_grad():
+                out = self._vb_terms_bpd(
+                    model,
+                    x_start=x_rep,
+                    x_t=x_t,
+                    t=t_batch,
+                    clip_denoised=clip_denoised,
+                    model_kwargs=kwargs_rep,
+                )
+            eps = self._predict_eps_from_xstart(x_t, t_batch, out["pred_xstart"])
+            vb.append(out["output"].view(num_ts, batch_size).t())
+            xstart_mse.append(
+                mean_flat((out["pred_xstart"] - x_rep) ** 2)
+                .view(num_ts, batch_size)
+                .t()
+            )
+            mse.append(mean_flat((eps - noise) ** 2).view(num_ts, batch_size).t())
+
+        vb = th.cat(vb, dim=1)
+        xstart_mse = th.cat(xstart_mse, dim=1)
+        mse = th.cat(mse, dim=1)
+
+        prior_bpd = self._prior_bpd(x_start)
+        total_bpd = vb.sum(dim=1) + prior_bpd
+        return {
+            "total_bpd": total_bpd,
+            "prior_bpd": prior_bpd,
+            "vb": vb,
+            "xstart_mse": xstart_mse,
+            "mse": mse,
+        }
+
     def scale_channels(self, x: th.Tensor) -> th.Tensor:
         if self.channel_scales is not None:
             x = x * th.from_numpy(self.channel_scales).to(x).reshape(
@@ -1118,6 +1611,13 @@ class _WrappedModel:
         return self.model(x, new_ts, **kwargs)
 
 
+def _alpha_sigma(alpha_bar: float):
+    """
+    Get the signal and noise scales of a step with the given alpha_bar.
+    """
+    return math.sqrt(alpha_bar), math.sqrt(max(1.0 - alpha_bar, 0.0))
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
     Extract values from a 1-D numpy array for a batch of indices.
@@ -1134,6 +1634,13 @@ def _extract_into_tensor(arr, timesteps, broadcast_shape):
     return res + th.zeros(broadcast_shape, device=timesteps.device)
 
 
+def _repeat_batch(x, count):
+    """
+    Tile a tensor `count` times along its batch dimension.
+    """
+    return x.repeat(count, *([1] * (len(x.shape) - 1)))
+
+
 def normal_kl(mean1, logvar1, mean2, logvar2):
     """
     Compute the KL divergence between two gaussians.
@@ -0,0 +1,553 @@
+"""
+A NumPy-only runtime for diffusion weights written by export_weights.py.
+
+This covers what production inference needs: the DiffusionPredictor forward
+pass, DDIM sampling, and vectorized refinement of the sampled poses. It does
+not import torch, so it starts quickly and keeps memory use low.
+
+Poses are handled as [N x 13] arrays in the DiffusionPrediction.to_vec()
+layout (origin, size, rotation, translation, post_translation).
+
+Usage:
+
+    python -m flatten_torch.lite weights.bin x1 y1 x2 y2 x3 y3 x4 y4
+"""
+
+import argparse
+import math
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .weights import CHANNEL_KEYS, read_index, read_weights
+
+REFINE_METHODS = ("gauss_newton", "adam")
+
+# Indices of the pose vector that are optimized during refinement. The
+# origin's z coordinate (index 2) is held at zero, as in solver.refine().
+FREE_PARAMS = np.array([0, 1, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12])
+
+
+class LiteDiffusionPredictor:
+    """
+    A NumPy port of model.DiffusionPredictor's forward pass.
+
+    :param params: the model's state dict as numpy arrays.
+    :param pos_emb_feats: the number of frequency features per condition
+                          channel, as in DiffusionPredictor.
+    :param diffusion_config: the diffusion config the model was trained
+                             with, or None for the original linear schedule
+                             without normalization.
+    """
+
+    def __init__(
+        self,
+        params: Dict[str, np.ndarray],
+        pos_emb_feats: int = 30,
+        diffusion_config: Optional[Dict[str, Any]] = None,
+    ):
+        stale = [k for k in CHANNEL_KEYS if k in params]
+        if stale:
+            raise ValueError(
+                f"weights contain {', '.join(stale)} as tensors; re-export them"
+                " so that the channel normalization is stored in the metadata"
+            )
+        self.pos_emb_feats = pos_emb_feats
+        self.diffusion_config = diffusion_config
+        self.time_embed = _linear_layers(params, "time_embed")
+        self.cond_embed = _linear_layers(params, "cond_embed")
+        self.input_embed = _linear_layers(params, "input_embed")
+        self.backbone = _linear_layers(params, "backbone")
+        self.d_model = self.time_embed[0][0].shape[1]
+        self.d_input = self.input_embed[0][0].shape[0]
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = False, **kwargs) -> "LiteDiffusionPredictor":
+        """
+        Load a model from an exported weight file or an inference checkpoint.
+
+        The diffusion config and the number of position embedding features,
+        if any, are read from the header metadata.
+
+        :param mmap: if True, memory-map the file rather than reading it.
+        """
+        params = read_weights(path, mmap=mmap)
+        metadata = read_index(path)[2]
+        model_config = metadata.get("model_config", None) or {}
+        if "pos_emb_feats" in model_config:
+            kwargs.setdefault("pos_emb_feats", model_config["pos_emb_feats"])
+        config = metadata.get("diffusion_config", None)
+        return cls(params, diffusion_config=config, **kwargs)
+
+    def __call__(self, x: np.ndarray, t: np.ndarray, cond: np.ndarray) -> np.ndarray:
+        """
+        :param x: an [N x d_input] batch of noised poses.
+        :param t: an [N] array of (unspaced) timesteps.
+        :param cond: an [N x 8] batch of flattened corners.
+        :return: an [N x 2*d_input] array of model outputs.
+        """
+        time_emb = _mlp(self.time_embed, timestep_embedding(t, self.d_model))
+        input_emb = _mlp(self.input_embed, x.astype(np.float32))
+        cond_emb = _mlp(
+            self.cond_embed,
+            frequency_pos_embedding(cond.astype(np.float32), self.pos_emb_feats),
+        )
+        h = (time_emb + input_emb + cond_emb) / np.float32(math.sqrt(3))
+        return _mlp(self.backbone, h)
+
+
+def _linear_layers(
+    params: Dict[str, np.ndarray], prefix: str
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Collect the Linear layers of an nn.Sequential, in order, as pairs of
+    (transposed weight, bias).
+    """
+    indices = sorted(
+        int(name.split(".")[1])
+        for name in params
+        if name.startswith(prefix + ".") and name.endswith(".weight")
+    )
+    assert indices, f"no layers found for {prefix}"
+    return [
+        (
+            np.ascontiguousarray(params[f"{prefix}.{i}.weight"].T, dtype=np.float32),
+            np.asarray(params[f"{prefix}.{i}.bias"], dtype=np.float32),
+        )
+        for i in indices
+    ]
+
+
+def _mlp(layers: List[Tuple[np.ndarray, np.ndarray]], h: np.ndarray) -> np.ndarray:
+    for i, (weight_t, bias) in enumerate(layers):
+        h = h @ weight_t + bias
+        if i + 1 < len(layers):
+            h = np.maximum(h, 0)
+    return h
+
+
+def frequency_pos_embedding(
+    x: np.ndarray, num_feats: int, max_arg: float = 1000.0
+) -> np.ndarray:
+    if num_feats == 0:
+        return x
+    assert num_feats % 2 == 0
+    coeffs = np.exp(
+        np.linspace(0, math.log(max_arg), num_feats // 2, dtype=np.float32)
+    ).astype(x.dtype)
+    args = (x[..., None] * coeffs).reshape(*x.shape[:-1], -1)
+    return np.concatenate([x, np.cos(args), np.sin(args)], axis=-1)
+
+
+def timestep_embedding(
+    timesteps: np.ndarray, dim: int, max_period: float = 10000
+) -> np.ndarray:
+    """
+    Create sinusoidal timestep embeddings, as model.timestep_embedding().
+
+    :param timesteps: a 1-D array of N indices, one per batch element.
+    :return: an [N x dim] float32 array of positional embeddings.
+    """
+    half = dim // 2
+    freqs = np.exp(
+        -math.log(max_period) * np.arange(half, dtype=np.float32) / half
+    ).astype(np.float32)
+    args = timesteps[:, None].astype(np.float32) * freqs[None]
+    embedding = np.concatenate([np.cos(args), np.sin(args)], axis=-1)
+    if dim % 2:
+        embedding = np.concatenate([embedding, np.zeros_like(embedding[:, :1])], -1)
+    return embedding
+
+
+class LiteDDIM:
+    """
+    Deterministic (eta=0) DDIM sampling over a respaced linear schedule.
+
+    This matches solver.create_sampling_diffusion(steps, config) followed by
+    ddim_sample_loop(), for configs using the linear schedule. Use
+    from_config() to check the config and read the schedule from it.
+
+    :param steps: the number of sampling steps.
+    :param timesteps: the number of timesteps the model was trained with.
+    :param channel_scales: the per-channel scales of the training config.
+    :param channel_biases: the per-channel biases of the training config.
+    """
+
+    def __init__(
+        self,
+        steps: int = 128,
+        timesteps: int = 1024,
+        channel_scales: Optional[np.ndarray] = None,
+        channel_biases: Optional[np.ndarray] = None,
+    ):
+        if not 1 <= steps <= timesteps:
+            raise ValueError(f"cannot divide {timesteps} timesteps into {steps}")
+        self.channel_scales = channel_scales
+        self.channel_biases = channel_biases
+
+        scale = 1000 / timesteps
+        betas = np.linspace(scale * 0.0001, scale * 0.02, timesteps, dtype=np.float64)
+        base_alphas_cumprod = np.cumprod(1.0 - betas)
+
+        # Same striding as gaussian_diffusion.space_timesteps(timesteps, str(steps)).
+        frac_stride = 1 if steps <= 1 else (timesteps - 1) / (steps - 1)
+        cur_idx = 0.0
+        use_timesteps = set()
+        for _ in range(steps):
+            use_timesteps.add(round(cur_idx))
+            cur_idx += frac_stride
+        self.timestep_map = np.array(sorted(use_timesteps))
+        alphas_cumprod = base_alphas_cumprod[self.timestep_map]
+        alphas_cumprod_prev = np.append(1.0, alphas_cumprod[:-1])
+
+        # Keep the per-step coefficients in float32, as the torch samplers do.
+        self.sqrt_recip_alphas_cumprod = np.sqrt(1.0 / alphas_cumprod).astype(
+            np.float32
+        )
+        self.sqrt_recipm1_alphas_cumprod = np.sqrt(1.0 / alphas_cumprod - 1).astype(
+            np.float32
+        )
+        alphas_cumprod_prev = alphas_cumprod_prev.astype(np.float32)
+        self.sqrt_alphas_cumprod_prev = np.sqrt(alphas_cumprod_prev)
+        self.sqrt_one_minus_alphas_cumprod_prev = np.sqrt(1 - alphas_cumprod_prev)
+
+    @classmethod
+    def from_config(
+        cls, steps: int, config: Optional[Dict[str, Any]] = None
+    ) -> "LiteDDIM":
+        """
+        Create a sampler for a model's diffusion config, such as the
+        diffusion_config of a LiteDiffusionPredictor.
+
+        :param config: the training diffusion config, or None for the
+                       original linear schedule without normalization.
+        """
+        config = config or {}
+        schedule = config.get("schedule", "linear")
+        if schedule != "linear" or config.get("schedule_args"):
+            raise ValueError(f"unsupported noise schedule: {schedule}")
+        mean_type = config.get("mean_type", "epsilon")
+        if mean_type != "epsilon":
+            raise ValueError(f"unsupported mean type: {mean_type}")
+        channels = {
+            k: np.array(config[k], dtype=np.float32)
+            for k in CHANNEL_KEYS
+            if config.get(k) is not None
+        }
+        return cls(steps, timesteps=config.get("timesteps", 1024), **channels)
+
+    @property
+    def num_timesteps(self) -> int:
+        return len(self.timestep_map)
+
+    def sample(
+        self,
+        model: LiteDiffusionPredictor,
+        cond: np.ndarray,
+        noise: Optional[np.ndarray] = None,
+        rng: Optional[np.random.Generator] = None,
+    ) -> np.ndarray:
+        """
+        Sample one pose per condition.
+
+        :param model: the model to sample from.
+        :param cond: an [N x 8] batch of flattened corners.
+        :param noise: if specified, the [N x d_input] starting noise.
+        :param rng: the generator to draw the starting noise from.
+        :return: an [N x d_input] array of unscaled samples.
+        """
+        if noise is None:
+            rng = rng if rng is not None else np.random.default_rng()
+            noise = rng.standard_normal((len(cond), model.d_input), dtype=np.float32)
+        x = noise.astype(np.float32)
+        t = np.empty(len(cond), dtype=np.int64)
+        for i in reversed(range(self.num_timesteps)):
+            t.fill(self.timestep_map[i])
+            eps = model(x, t, cond)[:, : model.d_input]
+            pred_xstart = (
+                self.sqrt_recip_alphas_cumprod[i] * x
+                - self.sqrt_recipm1_alphas_cumprod[i] * eps
+            )
+            # Re-derive eps from pred_xstart to follow ddim_sample() exactly.
+            eps = (
+                self.sqrt_recip_alphas_cumprod[i] * x - pred_xstart
+            ) / self.sqrt_recipm1_alphas_cumprod[i]
+            x = (
+                pred_xstart * self.sqrt_alphas_cumprod_prev[i]
+                + self.sqrt_one_minus_alphas_cumprod_prev[i] * eps
+            )
+        return self.unscale_channels(x)
+
+    def unscale_channels(self, x: np.ndarray) -> np.ndarray:
+        if self.channel_biases is not None:
+            x = x - self.channel_biases.astype(x.dtype)
+        if self.channel_scales is not None:
+            x = x / self.channel_scales.astype(x.dtype)
+        return x
+
+
+def euler_rotation(xyz: np.ndarray) -> np.ndarray:
+    """
+    :param xyz: a [... x 3] array of Euler angles.
+    :return: a [... x 3 x 3] array of rotation matrices, as
+             camera.euler_rotation().
+    """
+    cos_x, cos_y, cos_z = np.moveaxis(np.cos(xyz), -1, 0)
+    sin_x, sin_y, sin_z = np.moveaxis(np.sin(xyz), -1, 0)
+    # Expanded product rot_z @ rot_y @ rot_x.
+    rows = [
+        [
+            cos_z * cos_y,
+            cos_z * sin_y * sin_x - sin_z * cos_x,
+            cos_z * sin_y * cos_x + sin_z * sin_x,
+        ],
+        [
+            sin_z * cos_y,
+            sin_z * sin_y * sin_x + cos_z * cos_x,
+            sin_z * sin_y * cos_x - cos_z * sin_x,
+        ],
+        [-sin_y, cos_y * sin_x, cos_y * cos_x],
+    ]
+    return np.stack([np.stack(row, axis=-1) for row in rows], axis=-2)
+
+
+def corners_on_zplane(origin: np.ndarray, size: np.ndarray) -> np.ndarray:
+    """
+    Get a [... x 4 x 3] grid of 3D corner points, as data.corners_on_zplane().
+    """
+    zero = np.zeros_like(size[..., 0])
+    width = np.stack([size[..., 0], zero, zero], axis=-1)
+    height = np.stack([zero, size[..., 1], zero], axis=-1)
+    return np.stack(
+        [origin, origin + width, origin + width + height, origin + height], axis=-2
+    )
+
+
+def project(vecs: np.ndarray) -> np.ndarray:
+    """
+    Project the corners of a batch of poses.
+
+    :param vecs: a [... x 13] array of pose vectors.
+    :return: a [... x 4 x 2] array of projected corners.
+    """
+    origin, size, rotation, translation, post_translation = np.split(
+        vecs, [3, 5, 8, 11], axis=-1
+    )
+    corners = corners_on_zplane(origin, size)
+    p = np.einsum("...jk,...nk->...nj", euler_rotation(rotation), corners)
+    p = p + translation[..., None, :]
+    return post_translation[..., None, :] + p[..., :2] / -p[..., 2:]
+
+
+def reprojection_losses(vecs: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    :param vecs: an [N x 13] array of pose vectors.
+    :param targets: an [N x 4 x 2] array of projected corners.
+    :return: an [N] array of summed squared corner errors.
+    """
+    return np.square(project(vecs) - targets).reshape(len(vecs), -1).sum(-1)
+
+
+def _residuals_and_jacobian(
+    vecs: np.ndarray, targets: np.ndarray, eps: float = 1e-7
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the [N x 8] corner residuals and their forward-difference
+    [N x 8 x 12] Jacobian with respect to FREE_PARAMS, in a single batched
+    projection.
+    """
+    num_free = len(FREE_PARAMS)
+    steps = np.zeros((num_free + 1, vecs.shape[1]))
+    steps[1 + np.arange(num_free), FREE_PARAMS] = eps
+    points = vecs[:, None] + steps
+    residuals = (project(points) - targets[:, None]).reshape(len(vecs), num_free + 1, 8)
+    jacobian = (residuals[:, 1:] - residuals[:, :1]) / eps
+    return residuals[:, 0], np.swapaxes(jacobian, 1, 2)
+
+
+def _sanitize(losses: np.ndarray) -> np.ndarray:
+    return np.where(np.isfinite(losses), losses, np.inf)
+
+
+def refine_gauss_newton(
+    vecs: np.ndarray,
+    targets: np.ndarray,
+    iters: int = 20,
+    damping: float = 1e-3,
+    callback: Optional[Callable[[int, np.ndarray], None]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Refine poses with Levenberg-Marquardt, damping each pose separately.
+
+    Each iteration solves a 12x12 system per pose, so this typically
+    converges in tens of iterations rather than the hundreds Adam needs.
+
+    :param vecs: an [N x 13] array of pose vectors.
+    :param targets: an [N x 4 x 2] array of projected corners.
+    :param iters: the number of iterations.
+    :param damping: the initial damping factor.
+    :param callback: if specified, called as callback(step, losses) with the
+                     [N] losses before every step.
+    :return: a tuple (refined, losses).
+    """
+    vecs = vecs.astype(np.float64)
+    vecs[:, 2] = 0
+    targets = targets.astype(np.float64)
+    lambdas = np.full(len(vecs), damping)
+    residuals, jacobian = _residuals_and_jacobian(vecs, targets)
+    losses = _sanitize(np.square(residuals).sum(-1))
+    for i in range(iters):
+        if callback is not None:
+            callback(i, losses)
+        finite = np.isfinite(losses)[:, None, None]
+        jacobian = np.where(finite & np.isfinite(jacobian), jacobian, 0)
+        residuals = np.where(finite[..., 0], residuals, 0)
+        jtj = np.swapaxes(jacobian, 1, 2) @ jacobian
+        jtr = np.einsum("bij,bi->bj", jacobian, residuals)
+        diag = np.diagonal(jtj, axis1=1, axis2=2) + 1e-9
+        system = jtj + np.eye(len(FREE_PARAMS)) * (lambdas[:, None] * diag)[:, None]
+        delta = np.linalg.solve(system, -jtr[..., None])[..., 0]
+
+        proposal = vecs.copy()
+        proposal[:, FREE_PARAMS] += delta
+        new_residuals, new_jacobian = _residuals_and_jacobian(proposal, targets)
+        new_losses = _sanitize(np.square(new_residuals).sum(-1))
+        accept = new_losses < losses
+        vecs = np.where(accept[:, None], proposal, vecs)
+        residuals = np.where(accept[:, None], new_residuals, residuals)
+        jacobian = np.where(accept[:, None, None], new_jacobian, jacobian)
+        losses = np.where(accept, new_losses, losses)
+        lambdas = np.clip(np.where(accept, lambdas / 10, lambdas * 10), 1e-12, 1e12)
+    return vecs.astype(np.float32), losses
+
+
+def refine_adam(
+    vecs: np.ndarray,
+    targets: np.ndarray,
+    iters: int = 1000,
+    lr: float = 0.001,
+    callback: Optional[Callable[[int, np.ndarray], None]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Refine poses with Adam, as solver.refine(), using forward-difference
+    gradients of the reprojection loss.
+
+    :return: a tuple (refined, losses).
+    """
+    beta1, beta2, adam_eps = 0.9, 0.999, 1e-8
+    vecs = vecs.astype(np.float64)
+    vecs[:, 2] = 0
+    targets = targets.astype(np.float64)
+    params = vecs[:, FREE_PARAMS]
+    moment1 = np.zeros_like(params)
+    moment2 = np.zeros_like(params)
+    for i in range(iters):
+        residuals, jacobian = _residuals_and_jacobian(vecs, targets)
+        if callback is not None:
+            callback(i, _sanitize(np.square(residuals).sum(-1)))
+        grad = 2 * np.einsum("bij,bi->bj", jacobian, residuals)
+        grad = np.where(np.isfinite(grad), grad, 0)
+        moment1 = beta1 * moment1 + (1 - beta1) * grad
+        moment2 = beta2 * moment2 + (1 - beta2) * np.square(grad)
+        step_size = lr / (1 - beta1 ** (i + 1))
+        denom = np.sqrt(moment2) / math.sqrt(1 - beta2 ** (i + 1)) + adam_eps
+        params = params - step_size * moment1 / denom
+        vecs[:, FREE_PARAMS] = params
+    return vecs.astype(np.float32), _sanitize(reprojection_losses(vecs, targets))
+
+
+def refine(
+    vecs: np.ndarray,
+    targets: np.ndarray,
+    iters: int,
+    method: str = "gauss_newton",
+    lr: float = 0.001,
+    callback: Optional[Callable[[int, np.ndarray], None]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Refine poses with one of REFINE_METHODS.
+
+    :param lr: the Adam learning rate. Unused by "gauss_newton".
+    """
+    if method == "gauss_newton":
+        return refine_gauss_newton(vecs, targets, iters=iters, callback=callback)
+    elif method == "adam":
+        return refine_adam(vecs, targets, iters=iters, lr=lr, callback=callback)
+    else:
+        raise ValueError(f"unknown refinement method: {method}")
+
+
+def solve(
+    targets: np.ndarray,
+    model: LiteDiffusionPredictor,
+    diffusion: LiteDDIM,
+    num_candidates: int = 64,
+    iters: int = 20,
+    method: str = "gauss_newton",
+    lr: float = 0.001,
+    rng: Optional[np.random.Generator] = None,
+    callback: Optional[Callable[[int, np.ndarray], None]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sample candidates for each target, refine them, and keep the best.
+
+    :param targets: an [N x 4 x 2] array of projected corners.
+    :return: a tuple (vecs, losses) with the best [N x 13] poses and their
+             [N] reprojection losses.
+    """
+    targets = np.asarray(targets, dtype=np.float32)
+    num_targets = len(targets)
+    repeated = np.repeat(targets, num_candidates, axis=0)
+    vecs = diffusion.sample(model, repeated.reshape(len(repeated), -1), rng=rng)
+    vecs, losses = refine(
+        vecs, repeated, iters=iters, method=method, lr=lr, callback=callback
+    )
+    best = losses.reshape(num_targets, num_candidates).argmin(-1)
+    indices = np.arange(num_targets) * num_candidates + best
+    return vecs[indices], losses[indices]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument(
+        "--method", type=str, default="gauss_newton", choices=REFINE_METHODS
+    )
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("weights")
+    parser.add_argument("corners", type=float, nargs="+")
+    args = parser.parse_args()
+    assert len(args.corners) == 8, "must pass exactly 8 numerical arguments"
+
+    model = LiteDiffusionPredictor.load(args.weights, mmap=args.mmap)
+    diffusion = LiteDDIM.from_config(args.steps, model.diffusion_config)
+    targets = np.array(args.corners, dtype=np.float32).reshape(1, 4, 2)
+    vecs, losses = solve(
+        targets,
+        model,
+        diffusion,
+        num_candidates=args.batch_size,
+        iters=args.iters,
+        method=args.method,
+        lr=args.lr,
+        rng=np.random.default_rng(args.seed),
+    )
+    print(f"best loss: {losses[0]}")
+    origin, size, rotation, translation, post_translation = np.split(
+        vecs[0], [3, 5, 8, 11]
+    )
+    print(
+        f"origin={origin[:2].tolist()}"
+        f" size={size.tolist()}"
+        f" rotation={rotation.tolist()}"
+        f" translation={translation.tolist()}"
+        f" post_translation={post_translation.tolist()}"
+    )
+
+
+if __name__ == "__main__":
+    main()
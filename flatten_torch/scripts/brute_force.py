@@ -1,13 +1,22 @@
 import argparse
 
 import torch
-import torch.nn as nn
-from torch.optim import Adam
 
-from flatten_torch.camera import Camera, euler_rotation
-from flatten_torch.data import Batch, corners_on_zplane
-from flatten_torch.gaussian_diffusion import diffusion_from_config
-from flatten_torch.model import DiffusionPrediction, DiffusionPredictor
+from flatten_torch.solver import (
+    SAMPLERS,
+    CostModel,
+    SolverProfile,
+    create_sampling_diffusion,
+    load_diffusion_config,
+    load_diffusion_predictor,
+    load_direct_predictor,
+    load_mixture_predictor,
+    optimize_for_inference,
+    solve,
+    solve_anytime,
+    solve_with_initializer,
+    synchronized_time,
+)
 
 
 def main():
@@ -18,76 +27,133 @@ def main():
     parser.add_argument("--lr", type=float, default=0.001)
     parser.add_argument("--iters", type=int, default=1000)
     parser.add_argument("--diffusion-checkpoint", type=str, default=None)
+    parser.add_argument("--use_ema", action="store_true")
+    parser.add_argument("--mdn-checkpoint", type=str, default=None)
+    parser.add_argument("--fuse", action="store_true")
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--regression-checkpoint", type=str, default=None)
+    parser.add_argument("--init_iters", type=int, default=200)
+    parser.add_argument("--accept_loss", type=float, default=1e-6)
+    parser.add_argument("--sampler", type=str, default="ddpm", choices=SAMPLERS[1:])
+    parser.add_argument("--steps", type=int, default=128)
+    parser.add_argument("--guidance_scale", type=float, default=None)
+    parser.add_argument("--early_exit_tol", type=float, default=None)
+    parser.add_argument("--early_exit_loss", type=float, default=None)
+    parser.add_argument("--dedup_radius", type=float, default=None)
+    parser.add_argument("--top_k", type=int, default=None)
+    parser.add_argument("--halving_rounds", type=int, default=1)
+    parser.add_argument("--profile", type=str, default=None)
+    parser.add_argument("--deadline_ms", type=float, default=None)
     parser.add_argument("corners", type=float, nargs="+")
     args = parser.parse_args()
+    if args.profile is not None:
+        # Settings from the profile act as defaults for any flags not passed.
+        profile = SolverProfile.load(args.profile)
+        parser.set_defaults(
+            batch_size=profile.num_candidates,
+            lr=profile.lr,
+            iters=profile.iters,
+            sampler=profile.sampler,
+            steps=profile.steps,
+            dedup_radius=profile.dedup_radius,
+            top_k=profile.top_k,
+            halving_rounds=profile.halving_rounds,
+            guidance_scale=profile.guidance_scale,
+            early_exit_tol=profile.early_exit_tol,
+            early_exit_loss=profile.early_exit_loss,
+        )
+        args = parser.parse_args()
 
+    if args.deadline_ms is not None:
+        if args.halving_rounds > 1:
+            parser.error("--deadline_ms does not support --halving_rounds > 1")
+        if args.regression_checkpoint is not None:
+            parser.error(
+                "--deadline_ms cannot be combined with --regression-checkpoint"
+            )
     assert len(args.corners) == 8, "must pass exactly 8 numerical arguments"
     targets = torch.tensor([float(x) for x in args.corners], device=device).view(4, 2)
 
-    if args.diffusion_checkpoint is None:
-        batch = Batch.sample_batch(args.batch_size, device=device)
-        origin = nn.Parameter(batch.origin)
-        size = nn.Parameter(batch.size)
-        rotation = nn.Parameter(batch.rotation)
-        translation = nn.Parameter(batch.translation)
-        post_translation = nn.Parameter(batch.post_translation)
+    if args.sampler == "mdn":
+        assert args.mdn_checkpoint is not None, "mdn sampler needs --mdn-checkpoint"
+        model = load_mixture_predictor(args.mdn_checkpoint, device=device)
+        diffusion, sampler = None, "mdn"
+    elif args.diffusion_checkpoint is None:
+        model, diffusion, sampler = None, None, "prior"
     else:
-        model = DiffusionPredictor(device=device)
-        diffusion = diffusion_from_config(
-            dict(
-                schedule="linear",
-                timesteps=1024,
-                respacing="128",
-            )
-        )
-        with open(args.diffusion_checkpoint, "rb") as f:
-            obj = torch.load(f, map_location=device)
-            model.load_state_dict(obj["model"])
-
-        sample = diffusion.p_sample_loop(
-            model,
-            shape=(args.batch_size, model.d_input),
-            clip_denoised=False,
-            model_kwargs=dict(cond=targets.view(1, -1).repeat(args.batch_size, 1)),
+        model = load_diffusion_predictor(
+            args.diffusion_checkpoint, device=device, use_ema=args.use_ema
         )
-        pred = DiffusionPrediction.from_vec(sample)
-        origin, size, rotation, translation, post_translation = (
-            pred.origin,
-            pred.size,
-            pred.rotation,
-            pred.translation,
-            pred.post_translation,
+        if args.fuse or args.quantize:
+            model = optimize_for_inference(model, quantize=args.quantize)
+        diffusion = create_sampling_diffusion(
+            args.steps, config=load_diffusion_config(args.diffusion_checkpoint)
         )
+        sampler = args.sampler
 
-    origin = nn.Parameter(origin[:, :2].detach())
+    def log_step(i: int, losses: torch.Tensor):
+        print(f"step {i}: loss={losses.sum().item()} best={losses.min().item()}")
 
-    opt = Adam([origin, size, rotation, translation, post_translation], lr=args.lr)
-
-    for i in range(args.iters):
-        corners = corners_on_zplane(
-            torch.cat([origin, torch.zeros_like(origin[:, :1])], dim=-1), size
+    solve_kwargs = dict(
+        model=model,
+        diffusion=diffusion,
+        sampler=sampler,
+        num_candidates=args.batch_size,
+        iters=args.iters,
+        lr=args.lr,
+        dedup_radius=args.dedup_radius,
+        top_k=args.top_k,
+        halving_rounds=args.halving_rounds,
+        guidance_scale=args.guidance_scale,
+        early_exit_tol=args.early_exit_tol,
+        early_exit_loss=args.early_exit_loss,
+        callback=log_step,
+    )
+    if args.deadline_ms is not None:
+        sample_kwargs = dict(
+            model=model,
+            diffusion=diffusion,
+            sampler=sampler,
+            guidance_scale=args.guidance_scale,
+            early_exit_tol=args.early_exit_tol,
+            early_exit_loss=args.early_exit_loss,
         )
-        camera = Camera(
-            rotation=euler_rotation(rotation),
-            translation=translation,
-            post_translation=post_translation,
+        # Calibrate before the clock starts, as a long-running caller would.
+        cost_model = CostModel.measure(device, **sample_kwargs)
+        start = synchronized_time(device)
+        solution = solve_anytime(
+            targets[None],
+            args.deadline_ms,
+            cost_model=cost_model,
+            max_candidates=args.batch_size,
+            max_iters=args.iters,
+            lr=args.lr,
+            dedup_radius=args.dedup_radius,
+            top_k=args.top_k,
+            callback=log_step,
+            **sample_kwargs,
         )
-        proj = camera.project(corners).projected
-        losses = (proj - targets).pow(2).flatten(1).sum(-1)
-        loss = losses.sum()
-        opt.zero_grad()
-        loss.backward()
-        opt.step()
-        print(f"step {i}: loss={loss.item()} best={losses.min().item()}")
-
-    best_idx = torch.argmin(losses)
-    print(f"best loss: {losses[best_idx].item()}")
+        elapsed = (synchronized_time(device) - start) * 1000
+        print(f"solved in {elapsed:.01f}ms of {args.deadline_ms}ms")
+    elif args.regression_checkpoint is None:
+        solution = solve(targets[None], **solve_kwargs)
+    else:
+        initializer = load_direct_predictor(args.regression_checkpoint, device=device)
+        solution = solve_with_initializer(
+            targets[None],
+            initializer,
+            init_iters=args.init_iters,
+            accept_loss=args.accept_loss,
+            **solve_kwargs,
+        )
+    pred = solution.prediction
+    print(f"best loss: {solution.losses[0].item()}")
     print(
-        f"origin={origin[best_idx].tolist()}"
-        f" size={size[best_idx].tolist()}"
-        f" rotation={rotation[best_idx].tolist()}"
-        f" translation={translation[best_idx].tolist()}"
-        f" post_translation={post_translation[best_idx].tolist()}"
+        f"origin={pred.origin[0, :2].tolist()}"
+        f" size={pred.size[0].tolist()}"
+        f" rotation={pred.rotation[0].tolist()}"
+        f" translation={pred.translation[0].tolist()}"
+        f" post_translation={pred.post_translation[0].tolist()}"
     )
 
 
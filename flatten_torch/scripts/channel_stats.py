@@ -0,0 +1,64 @@
+"""
+Estimate per-channel statistics of the diffusion targets and write a
+diffusion config that normalizes each channel to zero mean and unit variance.
+
+The training script picks up the config from diffusion_config.yaml when it
+starts a new run, and stores it in the checkpoint so that samplers and
+export_weights.py use the same normalization.
+"""
+
+import argparse
+
+import torch
+import yaml
+
+from flatten_torch.data import Batch
+from flatten_torch.model import DiffusionPrediction
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_samples", type=int, default=1000000)
+    parser.add_argument("--batch_size", type=int, default=50000)
+    parser.add_argument("--min_std", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="diffusion_config.yaml")
+    args = parser.parse_args()
+
+    gen = torch.Generator().manual_seed(args.seed)
+    count = 0
+    total = 0.0
+    total_sq = 0.0
+    while count < args.num_samples:
+        batch = Batch.sample_batch(
+            min(args.batch_size, args.num_samples - count), generator=gen
+        )
+        vecs = DiffusionPrediction.from_batch(batch).to_vec().double()
+        total = total + vecs.sum(0)
+        total_sq = total_sq + vecs.pow(2).sum(0)
+        count += len(vecs)
+        print(f"sampled {count}/{args.num_samples}")
+
+    mean = total / count
+    std = (total_sq / count - mean.pow(2)).clamp(min=0).sqrt()
+
+    # Constant channels, like the origin z coordinate, are left untouched.
+    constant = std < args.min_std
+    scales = torch.where(constant, torch.ones_like(std), 1 / std)
+    biases = torch.where(constant, torch.zeros_like(mean), -mean * scales)
+    for i, (m, s) in enumerate(zip(mean.tolist(), std.tolist())):
+        print(f"channel {i}: mean={m:.05f} std={s:.05f}")
+
+    config = dict(
+        schedule="linear",
+        timesteps=1024,
+        channel_scales=scales.tolist(),
+        channel_biases=biases.tolist(),
+    )
+    with open(args.output, "w") as f:
+        yaml.safe_dump(config, f)
+    print(f"saved config to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Check that ReprojectionGuidance shifts the x_0 prediction of the score-based
+samplers by exactly its clipped step, at every sampling step.
+
+Usage:
+
+    python -m flatten_torch.scripts.check_guidance --checkpoint diffusion_model.pt
+
+Without a checkpoint, a randomly initialized model is used, since the check
+only depends on the diffusion coefficients.
+"""
+
+import argparse
+
+import torch
+
+from flatten_torch.data import Batch
+from flatten_torch.model import DiffusionPredictor
+from flatten_torch.solver import (
+    ReprojectionGuidance,
+    create_sampling_diffusion,
+    load_diffusion_config,
+    load_diffusion_predictor,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument("--steps", type=int, default=16)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--guidance_scale", type=float, default=0.1)
+    parser.add_argument("--tol", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+    if args.checkpoint is None:
+        model = DiffusionPredictor(device=device)
+        config = None
+    else:
+        model = load_diffusion_predictor(args.checkpoint, device=device)
+        config = load_diffusion_config(args.checkpoint)
+    diffusion = create_sampling_diffusion(args.steps, config=config)
+    guidance = ReprojectionGuidance(model, diffusion, scale=args.guidance_scale)
+
+    gen = torch.Generator().manual_seed(0)
+    batch = Batch.sample_batch(args.batch_size, generator=gen)
+    cond = batch.proj_corners.flatten(1)
+    x = torch.randn(len(cond), model.d_input, generator=gen)
+    timestep_map = torch.tensor(diffusion.timestep_map)
+
+    worst = 0.0
+    for i in range(diffusion.num_timesteps):
+        t = torch.full((len(cond),), i, dtype=torch.long)
+        with torch.no_grad():
+            out = diffusion.p_mean_variance(
+                model, x, t, clip_denoised=False, model_kwargs=dict(cond=cond)
+            )
+        guided = diffusion.condition_score(
+            guidance, out, x, t, model_kwargs=dict(cond=cond)
+        )
+        shift = guided["pred_xstart"] - out["pred_xstart"]
+        expected = guidance.xstart_step(x, timestep_map[t], cond)
+        ratio = (shift * expected).sum() / expected.pow(2).sum().clamp(min=1e-12)
+        err = ((shift - expected).norm() / expected.norm().clamp(min=1e-12)).item()
+        worst = max(worst, err)
+        print(f"step {i}: shift/step={ratio.item():.04f} rel_err={err:.03e}")
+
+    assert worst <= args.tol, f"x_0 shift differs from the step by {worst:.03e}"
+    print("guidance moves x_0 by its step at every sampling step")
+
+
+if __name__ == "__main__":
+    main()
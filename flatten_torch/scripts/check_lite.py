@@ -0,0 +1,96 @@
+"""
+Check that flatten_torch.lite matches the torch model and solver.
+
+Usage:
+
+    python -m flatten_torch.scripts.export_weights diffusion_model.pt weights.bin
+    python -m flatten_torch.scripts.check_lite diffusion_model.pt weights.bin
+"""
+
+import argparse
+
+import numpy as np
+import torch
+
+from flatten_torch import lite
+from flatten_torch.data import Batch
+from flatten_torch.model import DiffusionPrediction
+from flatten_torch.solver import (
+    create_sampling_diffusion,
+    load_diffusion_config,
+    load_diffusion_predictor,
+    project_prediction,
+    reprojection_losses,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=32)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--mmap", action="store_true")
+    parser.add_argument("--tol", type=float, default=1e-3)
+    parser.add_argument("checkpoint")
+    parser.add_argument("weights")
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+    model = load_diffusion_predictor(args.checkpoint, device=device)
+    diffusion = create_sampling_diffusion(
+        args.steps, config=load_diffusion_config(args.checkpoint)
+    )
+    lite_model = lite.LiteDiffusionPredictor.load(args.weights, mmap=args.mmap)
+    lite_diffusion = lite.LiteDDIM.from_config(args.steps, lite_model.diffusion_config)
+
+    gen = torch.Generator().manual_seed(0)
+    batch = Batch.sample_batch(args.batch_size, generator=gen)
+    cond = batch.proj_corners.flatten(1)
+    x = torch.randn(len(cond), model.d_input, generator=gen)
+    t = torch.randint(0, 1024, (len(cond),), generator=gen)
+    noise = torch.randn(len(cond), model.d_input, generator=gen)
+    with torch.no_grad():
+        expected_out = model(x, t, cond=cond)
+        expected_sample = diffusion.ddim_sample_loop(
+            model,
+            shape=tuple(noise.shape),
+            noise=noise,
+            clip_denoised=False,
+            model_kwargs=dict(cond=cond),
+        )
+    actual_out = lite_model(x.numpy(), t.numpy(), cond.numpy())
+    actual_sample = lite_diffusion.sample(lite_model, cond.numpy(), noise=noise.numpy())
+
+    pred = DiffusionPrediction.from_batch(batch)
+    expected_proj = project_prediction(pred).projected
+    actual_proj = lite.project(pred.to_vec().numpy())
+
+    errors = dict(
+        forward=_max_error(expected_out, actual_out),
+        ddim_sample=_max_error(expected_sample, actual_sample),
+        projection=_max_error(expected_proj, actual_proj),
+    )
+    for name, err in errors.items():
+        print(f"{name}: max_abs_err={err:.03e}")
+
+    targets = batch.proj_corners.numpy()
+    refined, losses = lite.refine(actual_sample, targets, iters=args.iters)
+    torch_losses = reprojection_losses(
+        DiffusionPrediction.from_vec(torch.from_numpy(refined)), batch.proj_corners
+    )
+    print(
+        f"refined losses: median={np.median(losses):.03e}"
+        f" torch_max_abs_err={_max_error(torch_losses, losses):.03e}"
+    )
+
+    failed = [name for name, err in errors.items() if not err <= args.tol]
+    assert not failed, f"lite runtime does not match torch: {', '.join(failed)}"
+    print("lite runtime matches torch")
+
+
+def _max_error(expected: torch.Tensor, actual: np.ndarray) -> float:
+    return (torch.from_numpy(np.asarray(actual)) - expected).abs().max().item()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import yaml
 
 from flatten_torch.data import Batch
 from flatten_torch.gaussian_diffusion import diffusion_from_config
@@ -11,6 +12,7 @@ from flatten_torch.model import DiffusionPrediction, DiffusionPredictor
 BATCH_SIZE = 50000
 SAVE_INTERVAL = 1000
 SAVE_PATH = "diffusion_model.pt"
+CONFIG_PATH = "diffusion_config.yaml"  # written by channel_stats.py
 EMA_RATE = 0.9999
 
 
@@ -18,11 +20,9 @@ def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = DiffusionPredictor(device=device)
     ema = [x.detach().clone() for x in model.parameters()]
-    diffusion = diffusion_from_config(
-        dict(
-            schedule="linear",
-            timesteps=1024,
-        )
+    diffusion_config = dict(
+        schedule="linear",
+        timesteps=1024,
     )
     opt = optim.Adam(params=model.parameters(), lr=1e-3)
     gen = torch.Generator(device=device)
@@ -36,6 +36,12 @@ def main():
             iter = obj["iter"]
             opt.load_state_dict(obj["opt"])
             model.load_state_dict(obj["model"])
+            diffusion_config = obj.get("diffusion_config", diffusion_config)
+    elif os.path.exists(CONFIG_PATH):
+        print(f"using diffusion config from {CONFIG_PATH}")
+        with open(CONFIG_PATH, "rb") as f:
+            diffusion_config = yaml.load(f, Loader=yaml.SafeLoader)
+    diffusion = diffusion_from_config(diffusion_config)
 
     while True:
         batch = Batch.sample_batch(BATCH_SIZE, generator=gen, device=device)
@@ -72,6 +78,7 @@ def main():
                         ema={k: v for (k, _), v in zip(model.named_parameters(), ema)},
                         gen=gen.get_state(),
                         iter=iter,
+                        diffusion_config=diffusion_config,
                     ),
                     f,
                 )
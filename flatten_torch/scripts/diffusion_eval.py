@@ -16,16 +16,13 @@ BATCH_SIZE = 32
 def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = DiffusionPredictor(device=device)
-    diffusion = diffusion_from_config(
-        dict(
-            schedule="linear",
-            timesteps=1024,
-            respacing="128",
-        )
-    )
     with open(LOAD_PATH, "rb") as f:
         obj = torch.load(f, map_location=device)
         model.load_state_dict(obj["ema"])
+    diffusion_config = obj.get(
+        "diffusion_config", dict(schedule="linear", timesteps=1024)
+    )
+    diffusion = diffusion_from_config(dict(diffusion_config, respacing="128"))
 
     batch = Batch.sample_batch(BATCH_SIZE, device=device)
 
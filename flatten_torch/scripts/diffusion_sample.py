@@ -9,16 +9,13 @@ LOAD_PATH = "diffusion_model.pt"
 def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = DiffusionPredictor(device=device)
-    diffusion = diffusion_from_config(
-        dict(
-            schedule="linear",
-            timesteps=1024,
-            respacing="128",
-        )
-    )
     with open(LOAD_PATH, "rb") as f:
         obj = torch.load(f, map_location=device)
         model.load_state_dict(obj["model"])
+    diffusion_config = obj.get(
+        "diffusion_config", dict(schedule="linear", timesteps=1024)
+    )
+    diffusion = diffusion_from_config(dict(diffusion_config, respacing="128"))
 
     # Test input, should be from origin (0.3, 0.3, 0), size 0.15, rotation y 0.1, camera x -1
     input = torch.tensor(
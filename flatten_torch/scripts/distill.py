@@ -0,0 +1,115 @@
+"""
+Distill a trained diffusion model into a smaller student, by training the
+student to match the teacher's outputs on noised training poses.
+
+Usage:
+
+    python -m flatten_torch.scripts.distill --teacher diffusion_model.pt \\
+        --d_model 96 --num_layers 3
+
+The student checkpoint records its architecture, so the solver entry points
+can load it like any other diffusion checkpoint. Compare students with
+student_table.py.
+"""
+
+import argparse
+import os
+
+import torch
+import torch.optim as optim
+
+from flatten_torch.data import Batch
+from flatten_torch.gaussian_diffusion import diffusion_from_config
+from flatten_torch.model import DiffusionPrediction, DiffusionPredictor
+from flatten_torch.solver import load_diffusion_config, load_diffusion_predictor
+
+SAVE_INTERVAL = 1000
+# Distillation runs are much shorter than teacher training, so the EMA has
+# to forget faster to be useful.
+EMA_RATE = 0.999
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--teacher", type=str, default="diffusion_model.pt")
+    parser.add_argument("--d_model", type=int, default=96)
+    parser.add_argument("--num_layers", type=int, default=5)
+    parser.add_argument("--batch_size", type=int, default=10000)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--max_iters", type=int, default=None)
+    parser.add_argument("--save_path", type=str, default=None)
+    args = parser.parse_args()
+    save_path = args.save_path or f"student_{args.d_model}x{args.num_layers}.pt"
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher = load_diffusion_predictor(args.teacher, device=device)
+    teacher.requires_grad_(False)
+    diffusion_config = load_diffusion_config(args.teacher) or dict(
+        schedule="linear", timesteps=1024
+    )
+    diffusion = diffusion_from_config(diffusion_config)
+
+    model = DiffusionPredictor(
+        device=device, d_model=args.d_model, num_layers=args.num_layers
+    )
+    ema = [x.detach().clone() for x in model.parameters()]
+    opt = optim.Adam(params=model.parameters(), lr=args.lr)
+    gen = torch.Generator(device=device)
+    iter = 0
+
+    if os.path.exists(save_path):
+        print(f"loading from {save_path}")
+        with open(save_path, "rb") as f:
+            obj = torch.load(f)
+            gen.set_state(obj["gen"].cpu())
+            iter = obj["iter"]
+            opt.load_state_dict(obj["opt"])
+            model.load_state_dict(obj["model"])
+            ema = [obj["ema"][k].to(device) for k, _ in model.named_parameters()]
+
+    while args.max_iters is None or iter < args.max_iters:
+        batch = Batch.sample_batch(args.batch_size, generator=gen, device=device)
+        cond = batch.proj_corners.flatten(1)
+        x_start = diffusion.scale_channels(
+            DiffusionPrediction.from_batch(batch).to_vec()
+        )
+        t = torch.randint(
+            low=0,
+            high=diffusion.num_timesteps,
+            size=(len(batch),),
+            generator=gen,
+            device=device,
+        )
+        noise = torch.randn(x_start.shape, device=device, generator=gen)
+        x_t = diffusion.q_sample(x_start, t, noise=noise)
+        with torch.no_grad():
+            target = teacher(x_t, t, cond=cond)
+        # Match the variance outputs as well as eps, so that the student can
+        # stand in for the teacher with every sampler.
+        loss = (model(x_t, t, cond=cond) - target).pow(2).mean()
+        opt.zero_grad()
+        loss.backward()
+        opt.step()
+        for param, ema_param in zip(model.parameters(), ema):
+            with torch.no_grad():
+                ema_param.mul_(EMA_RATE).add_(param, alpha=1 - EMA_RATE)
+        print(f"iter={iter} loss={loss.item()}")
+        iter += 1
+        if iter % SAVE_INTERVAL == 0 or iter == args.max_iters:
+            with open(save_path, "wb") as f:
+                torch.save(
+                    dict(
+                        opt=opt.state_dict(),
+                        model=model.state_dict(),
+                        ema={k: v for (k, _), v in zip(model.named_parameters(), ema)},
+                        gen=gen.get_state(),
+                        iter=iter,
+                        diffusion_config=diffusion_config,
+                        model_config=model.config,
+                    ),
+                    f,
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Convert a training checkpoint into a weights-only inference checkpoint that
+the solver loaders can memory-map.
+
+Usage:
+
+    python -m flatten_torch.scripts.export_inference \\
+        diffusion_model.pt diffusion_model.bin
+"""
+
+import argparse
+import os
+
+import torch
+
+from flatten_torch.checkpoint import save_inference_checkpoint
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--use_model", action="store_true")
+    parser.add_argument("input_path")
+    parser.add_argument("output_path")
+    args = parser.parse_args()
+
+    obj = torch.load(args.input_path, map_location="cpu")
+    sd = obj["model" if args.use_model else "ema"]
+    save_inference_checkpoint(
+        args.output_path,
+        sd,
+        diffusion_config=obj.get("diffusion_config", None),
+        model_config=obj.get("model_config", None),
+    )
+    print(f"wrote {os.path.getsize(args.output_path)} bytes to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,124 @@
 import argparse
-import io
-import json
-import struct
-from typing import List, Union
+import os
+from typing import Any, Dict, List, Optional, Union
 
+import numpy as np
 import torch
 
+from flatten_torch.data import Batch
+from flatten_torch.model import DiffusionPredictor
+from flatten_torch.weights import (
+    CHANNEL_KEYS,
+    STORAGE_DTYPES,
+    read_weights,
+    write_weights,
+)
+
 
 def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument("--dtype", type=str, default="float32", choices=STORAGE_DTYPES)
+    parser.add_argument("--check", action="store_true")
     parser.add_argument("input_path")
     parser.add_argument("output_path")
     args = parser.parse_args()
 
-    sd = torch.load(args.input_path, map_location="cpu")
-    if "ema" in sd:
-        sd = sd["ema"]
-
-    metadata = bytes(json.dumps([(k, v.shape) for k, v in sd.items()]), "utf-8")
-    data = io.BytesIO()
+    obj = torch.load(args.input_path, map_location="cpu")
+    sd = obj["ema"] if "ema" in obj else obj
+    metadata = header_metadata(
+        obj.get("diffusion_config", None), obj.get("model_config", None)
+    )
+    if metadata is not None:
+        # The browser loader only reads the version 1 format, and would
+        # silently run the wrong model or schedule if it could read the file.
+        print(
+            f"warning: storing {' and '.join(metadata)} in the version 2 format,"
+            " which the browser cannot load"
+        )
 
+    arrays = {k: v.detach().float().numpy() for k, v in sd.items()}
     with open(args.output_path, "wb") as f:
-        f.write(struct.pack("<I", len(metadata)))
-        f.write(metadata)
-        for v in sd.values():
-            data = v.reshape(-1).float().tolist()
-            f.write(struct.pack(f"<{len(data)}f", *data))
+        write_weights(f, arrays, dtype=args.dtype, metadata=metadata)
+    print(f"wrote {os.path.getsize(args.output_path)} bytes to {args.output_path}")
+
+    if args.check:
+        check_round_trip(
+            sd,
+            read_weights(args.output_path),
+            model_config=obj.get("model_config", None),
+        )
+
+
+def header_metadata(
+    diffusion_config: Optional[Dict[str, Any]],
+    model_config: Optional[Dict[str, Any]],
+) -> Optional[Dict[str, Any]]:
+    """
+    Get the header metadata carrying the configs that the browser cannot
+    apply, so that loaders of the exported weights use the same schedule,
+    channel normalization and architecture.
+
+    The browser hardcodes the original linear schedule without
+    normalization and 30 position embedding features; it reads every other
+    architecture setting, including the depth, from the tensor shapes.
+
+    :return: None if the browser can load the weights as they are.
+    """
+    metadata = {}
+    if diffusion_config is not None and not (
+        diffusion_config.get("schedule") == "linear"
+        and diffusion_config.get("timesteps") == 1024
+        and diffusion_config.get("mean_type", "epsilon") == "epsilon"
+        and not diffusion_config.get("schedule_args")
+        and all(diffusion_config.get(k) is None for k in CHANNEL_KEYS)
+    ):
+        metadata["diffusion_config"] = diffusion_config
+    if model_config is not None and model_config.get("pos_emb_feats", 30) != 30:
+        metadata["model_config"] = model_config
+    return metadata or None
+
+
+def check_round_trip(
+    sd: Dict[str, torch.Tensor],
+    loaded: Dict[str, np.ndarray],
+    model_config: Optional[Dict[str, Any]] = None,
+):
+    """
+    Report how far the exported weights are from the original checkpoint,
+    and, for diffusion models, how much the model outputs change.
+
+    :param model_config: the architecture of the diffusion model, if it is
+                         not the default.
+    """
+    assert list(sd.keys()) == list(loaded.keys()), "tensor names do not match"
+    for name, value in sd.items():
+        expected = value.detach().float()
+        actual = torch.from_numpy(np.array(loaded[name]))
+        assert actual.shape == expected.shape, f"shape mismatch for {name}"
+        err = (actual - expected).abs().max().item()
+        rel = err / max(expected.abs().max().item(), 1e-8)
+        print(f"{name}: max_abs_err={err:.03e} rel_err={rel:.03e}")
+
+    if "backbone.0.weight" not in sd:
+        return
+    device = torch.device("cpu")
+    model_config = model_config or {}
+    original = DiffusionPredictor(device=device, **model_config)
+    original.load_state_dict(sd)
+    exported = DiffusionPredictor(device=device, **model_config)
+    exported.load_state_dict(
+        {k: torch.from_numpy(np.array(v)) for k, v in loaded.items()}
+    )
+
+    gen = torch.Generator().manual_seed(0)
+    batch = Batch.sample_batch(1000, generator=gen)
+    x = torch.randn(len(batch), original.d_input, generator=gen)
+    t = torch.randint(0, 1024, (len(batch),), generator=gen)
+    with torch.no_grad():
+        expected = original(x, t, cond=batch.proj_corners.flatten(1))
+        actual = exported(x, t, cond=batch.proj_corners.flatten(1))
+    print(f"model output mse: {(actual - expected).pow(2).mean().item():.03e}")
+    print(f"model output max_abs_err: {(actual - expected).abs().max().item():.03e}")
 
 
 def round_floats(floats: Union[List[float], float], prec: int):
@@ -0,0 +1,132 @@
+"""
+Measure the import time of the package entry points with python -X importtime,
+and check them against time budgets and lists of modules they must not pull
+in.
+
+Usage:
+
+    python -m flatten_torch.scripts.import_time
+    python -m flatten_torch.scripts.import_time --budget_scale 2 flatten_torch.lite
+
+Exits with a non-zero status if any check fails.
+"""
+
+import argparse
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class ImportCheck:
+    module: str
+    budget_ms: Optional[float]
+    forbidden: Tuple[str, ...] = ()
+
+
+# Budgets are for a warm file cache; torch alone takes seconds to import, so
+# the torch-based entry points are mostly guarded by their forbidden lists.
+CHECKS = (
+    ImportCheck("flatten_torch", budget_ms=20, forbidden=("numpy", "torch")),
+    ImportCheck(
+        "flatten_torch.lite", budget_ms=200, forbidden=("torch", "yaml", "PIL")
+    ),
+    ImportCheck(
+        "flatten_torch.solver",
+        budget_ms=5000,
+        forbidden=("yaml", "torchvision", "PIL"),
+    ),
+    ImportCheck(
+        "flatten_torch.scripts.brute_force",
+        budget_ms=5000,
+        forbidden=("yaml", "torchvision", "PIL"),
+    ),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--budget_scale", type=float, default=1.0)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("modules", type=str, nargs="*")
+    args = parser.parse_args()
+
+    checks = [c for c in CHECKS if not args.modules or c.module in args.modules]
+    checks += [
+        ImportCheck(m, budget_ms=None)
+        for m in args.modules
+        if m not in [c.module for c in CHECKS]
+    ]
+
+    # Modules imported by interpreter startup are not attributed to anything.
+    startup = set(import_times("sys"))
+    failures = []
+    for check in checks:
+        times = min(
+            (import_times(check.module) for _ in range(args.repeats)),
+            key=lambda t: t[check.module],
+        )
+        times = {k: v for k, v in times.items() if k not in startup}
+        total_ms = times[check.module]
+        budget = (
+            None if check.budget_ms is None else check.budget_ms * args.budget_scale
+        )
+        status = "ok"
+        if budget is not None and total_ms > budget:
+            status = "over budget"
+            failures.append(f"{check.module} took {total_ms:.01f}ms > {budget:.01f}ms")
+        leaked = sorted(m for m in check.forbidden if m in times)
+        if leaked:
+            status = "forbidden imports"
+            failures.append(f"{check.module} imported {', '.join(leaked)}")
+        budget_str = "none" if budget is None else f"{budget:.01f}ms"
+        print(f"{check.module}: {total_ms:.01f}ms (budget {budget_str}) {status}")
+        for name, ms in slowest_roots(times, check.module, args.top):
+            print(f"  {name}: {ms:.01f}ms")
+
+    if failures:
+        for failure in failures:
+            print(f"FAILED: {failure}")
+        sys.exit(1)
+
+
+def import_times(module: str) -> Dict[str, float]:
+    """
+    Import a module in a fresh interpreter.
+
+    :return: a dict mapping every newly imported module (including
+             submodules) to its cumulative import time in milliseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def slowest_roots(
+    times: Dict[str, float], module: str, count: int
+) -> List[Tuple[str, float]]:
+    """
+    Get the slowest top-level packages imported while importing module.
+    """
+    roots: Dict[str, float] = {}
+    for name, ms in times.items():
+        root = name.split(".")[0]
+        if root != module.split(".")[0]:
+            roots[root] = max(roots.get(root, 0.0), ms)
+    return sorted(roots.items(), key=lambda x: -x[1])[:count]
+
+
+if __name__ == "__main__":
+    main()
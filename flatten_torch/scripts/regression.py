@@ -1,40 +1,60 @@
+import os
+
 import torch
-import torch.nn as nn
 import torch.optim as optim
 
 from flatten_torch.data import Batch
+from flatten_torch.model import DiffusionPrediction, DirectPredictor
 
 BATCH_SIZE = 10000
+SAVE_INTERVAL = 1000
+SAVE_PATH = "regression_model.pt"
+EMA_RATE = 0.9999
 
 
 def main():
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    model = nn.Sequential(
-        nn.Linear(8, 256),
-        nn.GELU(),
-        nn.Linear(256, 256),
-        nn.GELU(),
-        nn.Linear(256, 11),  # origin(3) + size(2) + rotation(3) + translation(3)
-    ).to(device)
+    model = DirectPredictor(device=device)
+    ema = [x.detach().clone() for x in model.parameters()]
     opt = optim.Adam(params=model.parameters(), lr=1e-3)
-
+    gen = torch.Generator(device=device)
     iter = 0
+
+    if os.path.exists(SAVE_PATH):
+        print(f"loading from {SAVE_PATH}")
+        with open(SAVE_PATH, "rb") as f:
+            obj = torch.load(f)
+            gen.set_state(obj["gen"].cpu())
+            iter = obj["iter"]
+            opt.load_state_dict(obj["opt"])
+            model.load_state_dict(obj["model"])
+            ema = [obj["ema"][k].to(device) for k, _ in model.named_parameters()]
+
     while True:
-        batch = Batch.sample_batch(BATCH_SIZE, device=device)
+        batch = Batch.sample_batch(BATCH_SIZE, generator=gen, device=device)
         output = model(batch.proj_corners.flatten(1))
-        origin, size, rotation, translation = torch.split(output, [3, 2, 3, 3], dim=-1)
-        mse = (
-            (origin - batch.origin).pow(2).sum(-1)
-            + (size - batch.size).pow(2).sum(-1)
-            + (rotation - batch.rotation).pow(2).sum(-1)
-            + (translation - batch.translation).pow(2).sum(-1)
-        ).mean()
+        target = DiffusionPrediction.from_batch(batch).to_vec()
+        mse = (output - target).pow(2).sum(-1).mean()
         opt.zero_grad()
         mse.backward()
         opt.step()
+        for param, ema_param in zip(model.parameters(), ema):
+            with torch.no_grad():
+                ema_param.mul_(EMA_RATE).add_(param, alpha=1 - EMA_RATE)
         print(f"iter={iter} loss={mse.item()}")
         iter += 1
+        if iter % SAVE_INTERVAL == 0:
+            with open(SAVE_PATH, "wb") as f:
+                torch.save(
+                    dict(
+                        opt=opt.state_dict(),
+                        model=model.state_dict(),
+                        ema={k: v for (k, _), v in zip(model.named_parameters(), ema)},
+                        gen=gen.get_state(),
+                        iter=iter,
+                    ),
+                    f,
+                )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+"""
+Compare diffusion checkpoints of different sizes, such as a teacher and the
+students from distill.py, by network cost and eval-suite success rate.
+
+Usage:
+
+    python -m flatten_torch.scripts.student_table --eval_set eval_set.pt \\
+        diffusion_model.pt student_96x5.pt student_64x3.pt
+"""
+
+import argparse
+import os
+
+import numpy as np
+import torch
+
+from flatten_torch.bench import BenchConfig, bench_config, load_eval_batch
+from flatten_torch.solver import (
+    DIFFUSION_SAMPLERS,
+    load_diffusion_config,
+    load_diffusion_predictor,
+    synchronized_time,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--eval_set", type=str, default="eval_set.pt")
+    parser.add_argument("--num_samples", type=int, default=2048)
+    parser.add_argument(
+        "--sampler", type=str, default="ddim", choices=DIFFUSION_SAMPLERS
+    )
+    parser.add_argument("--steps", type=int, default=32)
+    parser.add_argument("--candidates", type=int, default=128)
+    parser.add_argument("--iters", type=int, default=200)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--success_thresh", type=float, default=1e-3)
+    parser.add_argument("--latency_trials", type=int, default=5)
+    parser.add_argument("--step_trials", type=int, default=50)
+    parser.add_argument("checkpoints", type=str, nargs="+")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    batch = load_eval_batch(args.eval_set, num_samples=args.num_samples).to(device)
+    print(f"evaluating on {len(batch)} targets")
+    config = BenchConfig(
+        sampler=args.sampler,
+        steps=args.steps,
+        num_candidates=args.candidates,
+        iters=args.iters,
+    )
+
+    rows = []
+    for path in args.checkpoints:
+        model = load_diffusion_predictor(path, device=device)
+        step_ms = step_latency(model, args.candidates, args.step_trials)
+        result = bench_config(
+            config,
+            batch,
+            model,
+            diffusion_config=load_diffusion_config(path),
+            lr=args.lr,
+            success_thresh=args.success_thresh,
+            latency_trials=args.latency_trials,
+        )
+        num_params = sum(p.numel() for p in model.parameters())
+        rows.append(
+            [
+                os.path.basename(path),
+                str(model.d_model),
+                str(model.num_layers),
+                str(num_params),
+                f"{step_ms:.03f}",
+                f"{result.success_rate:.04f}",
+                f"{result.error_percentiles[50]:.02e}",
+                f"{result.latency_ms:.01f}",
+            ]
+        )
+
+    header = [
+        "checkpoint",
+        "d_model",
+        "layers",
+        "params",
+        "step_ms",
+        "success",
+        "p50_error",
+        "solve_ms",
+    ]
+    print(f"| {' | '.join(header)} |")
+    print(f"|{'|'.join('---' for _ in header)}|")
+    for row in rows:
+        print(f"| {' | '.join(row)} |")
+
+
+def step_latency(model: torch.nn.Module, num_rows: int, trials: int) -> float:
+    """
+    Measure the median time of one network evaluation on num_rows rows, as
+    in one step of sampling candidates for a single target.
+    """
+    device = next(model.parameters()).device
+    x = torch.randn(num_rows, model.d_input, device=device)
+    t = torch.full((num_rows,), 500, device=device)
+    cond = torch.randn(1, model.d_cond, device=device).expand(num_rows, -1)
+    times = []
+    with torch.inference_mode():
+        model(x, t, cond=cond)
+        for _ in range(trials):
+            start = synchronized_time(device)
+            model(x, t, cond=cond)
+            times.append(synchronized_time(device) - start)
+    return float(np.median(times) * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Solve a sequence of quads, one frame per line of eight numbers in a text
+file, reusing each frame's solution to initialize the next.
+"""
+
+import argparse
+import json
+
+import numpy as np
+import torch
+
+from flatten_torch.solver import (
+    SAMPLERS,
+    create_sampling_diffusion,
+    load_diffusion_config,
+    load_diffusion_predictor,
+    load_mixture_predictor,
+    solve_sequence,
+)
+
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=1000)
+    parser.add_argument("--lr", type=float, default=0.001)
+    parser.add_argument("--iters", type=int, default=1000)
+    parser.add_argument("--track_iters", type=int, default=50)
+    parser.add_argument("--max_track_loss", type=float, default=1e-6)
+    parser.add_argument("--diffusion-checkpoint", type=str, default=None)
+    parser.add_argument("--use_ema", action="store_true")
+    parser.add_argument("--mdn-checkpoint", type=str, default=None)
+    parser.add_argument("--sampler", type=str, default="ddpm", choices=SAMPLERS[1:])
+    parser.add_argument("--steps", type=int, default=128)
+    parser.add_argument("--guidance_scale", type=float, default=None)
+    parser.add_argument("--early_exit_tol", type=float, default=None)
+    parser.add_argument("--early_exit_loss", type=float, default=None)
+    parser.add_argument("corners_path", type=str)
+    args = parser.parse_args()
+
+    corners = np.loadtxt(args.corners_path, dtype=np.float32, ndmin=2)
+    assert corners.shape[1] == 8, "each line must contain exactly 8 numbers"
+    corners = torch.from_numpy(corners).to(device).view(-1, 4, 2)
+
+    if args.sampler == "mdn":
+        assert args.mdn_checkpoint is not None, "mdn sampler needs --mdn-checkpoint"
+        model = load_mixture_predictor(args.mdn_checkpoint, device=device)
+        diffusion, sampler = None, "mdn"
+    elif args.diffusion_checkpoint is None:
+        model, diffusion, sampler = None, None, "prior"
+    else:
+        model = load_diffusion_predictor(
+            args.diffusion_checkpoint, device=device, use_ema=args.use_ema
+        )
+        diffusion = create_sampling_diffusion(
+            args.steps, config=load_diffusion_config(args.diffusion_checkpoint)
+        )
+        sampler = args.sampler
+
+    def log_frame(i: int, tracked: bool):
+        print(f"frame {i}: {'tracked' if tracked else 'full solve'}")
+
+    solution = solve_sequence(
+        corners,
+        track_iters=args.track_iters,
+        max_track_loss=args.max_track_loss,
+        lr=args.lr,
+        callback=log_frame,
+        model=model,
+        diffusion=diffusion,
+        sampler=sampler,
+        num_candidates=args.batch_size,
+        iters=args.iters,
+        guidance_scale=args.guidance_scale,
+        early_exit_tol=args.early_exit_tol,
+        early_exit_loss=args.early_exit_loss,
+    )
+    pred = solution.prediction
+    for i in range(len(corners)):
+        print(
+            json.dumps(
+                dict(
+                    frame=i,
+                    loss=solution.losses[i].item(),
+                    origin=pred.origin[i, :2].tolist(),
+                    size=pred.size[i].tolist(),
+                    rotation=pred.rotation[i].tolist(),
+                    translation=pred.translation[i].tolist(),
+                    post_translation=pred.post_translation[i].tolist(),
+                )
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
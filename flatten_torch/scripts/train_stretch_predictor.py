@@ -3,20 +3,22 @@ Train a model to predict the original aspect ratio of photos given a square resi
 """
 
 import argparse
-import glob
+import json
 import math
 import os
 import random
-from typing import Iterator, Sequence, Tuple
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torchvision.transforms.functional as TF
 from PIL import Image, ImageFile
 from torch.optim import Adam
 from torch.utils.data import DataLoader, Dataset
-from torchvision.transforms import ColorJitter, GaussianBlur, Resize, ToTensor
+from torchvision.transforms import ColorJitter, GaussianBlur, ToTensor
 
 from flatten_torch.model import StretchPredictor
 
@@ -26,16 +28,69 @@ def main():
     parser.add_argument("--lr", type=float, default=0.0003)
     parser.add_argument("--batch_size", type=int, default=32)
     parser.add_argument("--save_interval", type=int, default=100)
+    parser.add_argument("--eval_interval", type=int, default=10)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--test_workers", type=int, default=1)
+    parser.add_argument("--prefetch_factor", type=int, default=4)
+    parser.add_argument("--no_pin_memory", action="store_true")
     parser.add_argument("--checkpoint", type=str, default="stretch_predictor.pt")
-    parser.add_argument("image_dir", type=str, nargs="+")
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--build_cache", action="store_true")
+    parser.add_argument("--cache_size", type=int, default=256)
+    parser.add_argument("--no_draft", action="store_true")
+    parser.add_argument("--benchmark", type=int, default=None)
+    parser.add_argument("--cpu_augment", action="store_true")
+    parser.add_argument("--check_augment", type=int, default=None)
+    parser.add_argument("image_dir", type=str, nargs="*")
     args = parser.parse_args()
 
+    if args.build_cache:
+        assert args.cache_dir is not None, "must pass --cache_dir to build a cache"
+        assert len(args.image_dir), "must pass at least one image directory"
+        build_image_cache(args.image_dir, args.cache_dir, min_side=args.cache_size)
+        return
+
+    if args.benchmark is not None:
+        assert len(args.image_dir), "must pass image directories to benchmark"
+        for draft in [False, True]:
+            rate = benchmark_dataset(
+                StretchDataset(args.image_dir, draft=draft), args.benchmark
+            )
+            print(f"draft={draft}: {rate:.02f} images/sec per worker")
+        return
+
+    if args.check_augment is not None:
+        assert len(args.image_dir), "must pass image directories to check"
+        check_batch_augment(StretchDataset(args.image_dir), args.check_augment)
+        return
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    test_ds = StretchDataset(args.image_dir, valid=True)
-    train_ds = StretchDataset(args.image_dir)
-    test_data = iterate_data(test_ds, batch_size=args.batch_size)
-    train_data = iterate_data(train_ds, batch_size=args.batch_size)
+    if args.cache_dir is not None:
+        test_ds = CachedStretchDataset(args.cache_dir, valid=True)
+        train_ds = CachedStretchDataset(args.cache_dir, cpu_augment=args.cpu_augment)
+    else:
+        assert len(args.image_dir), "must pass image directories or --cache_dir"
+        draft = not args.no_draft
+        test_ds = StretchDataset(args.image_dir, valid=True, draft=draft)
+        train_ds = StretchDataset(
+            args.image_dir, draft=draft, cpu_augment=args.cpu_augment
+        )
+    pin_memory = device.type == "cuda" and not args.no_pin_memory
+    test_data = iterate_data(
+        test_ds,
+        batch_size=args.batch_size,
+        num_workers=args.test_workers,
+        prefetch_factor=args.prefetch_factor,
+        pin_memory=pin_memory,
+    )
+    train_data = iterate_data(
+        train_ds,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        pin_memory=pin_memory,
+    )
     print(f"train images: {len(train_ds)}")
     print(f"test images: {len(test_ds)}")
 
@@ -46,29 +101,46 @@ def main():
 
     print(f"total of {sum(x.numel() for x in model.parameters())} parameters.")
     opt = Adam(model.parameters(), lr=args.lr)
+    augment = None if args.cpu_augment else BatchAugment()
 
     i = 0
     test_losses = []
     best_test_loss = None
+    # The test loss is only measured every eval_interval steps, so average
+    # over enough evaluations to still cover roughly save_interval steps.
+    test_window = max(1, args.save_interval // args.eval_interval)
 
     while True:
-        train_x, train_y = next(train_data)
-        test_x, test_y = next(test_data)
+        data_start = time.perf_counter()
+        train_x, train_y, train_scale = next(train_data)
+        data_wait = time.perf_counter() - data_start
         i += 1
-        loss = model.losses(train_x.to(device), train_y.to(device)).mean()
-        with torch.no_grad():
-            test_loss = model.losses(test_x.to(device), test_y.to(device)).mean()
+        train_x = train_x.to(device, non_blocking=pin_memory)
+        train_y = train_y.to(device, non_blocking=pin_memory)
+        if augment is not None:
+            with torch.no_grad():
+                train_x = augment(train_x, sigma_scale=train_scale.to(device))
+        loss = model.losses(train_x, train_y).mean()
+        test_loss = None
+        if i % args.eval_interval == 0:
+            test_x, test_y, _ = next(test_data)
+            with torch.no_grad():
+                test_loss = model.losses(test_x.to(device), test_y.to(device)).mean()
         opt.zero_grad()
         loss.backward()
         opt.step()
+        if test_loss is None:
+            print(f"step {i}: loss={loss.item():.05} data_wait={data_wait:.04f}")
+            continue
         print(
-            f"step {i}: loss={loss.item():.05} test={test_loss.item():.05}"
+            f"step {i}: loss={loss.item():.05} data_wait={data_wait:.04f}"
+            f" test={test_loss.item():.05}"
             f" best_test={(best_test_loss if best_test_loss is not None else test_loss):.05}"
         )
         test_losses.append(test_loss.item())
-        if len(test_losses) > args.save_interval:
+        if len(test_losses) > test_window:
             del test_losses[0]
-        elif len(test_losses) < args.save_interval:
+        elif len(test_losses) < test_window:
             continue
         mean_test_loss = np.mean(test_losses)
         if best_test_loss is None or mean_test_loss < best_test_loss:
@@ -79,13 +151,24 @@ def main():
 
 
 def iterate_data(
-    dataset: Dataset, batch_size: int
-) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+    dataset: Dataset,
+    batch_size: int,
+    num_workers: int = 2,
+    prefetch_factor: int = 2,
+    pin_memory: bool = False,
+) -> Iterator[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
     loader = DataLoader(
-        dataset, batch_size=batch_size, num_workers=2, worker_init_fn=_seed_worker
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        worker_init_fn=_seed_worker,
+        pin_memory=pin_memory,
+        # Keep workers alive between epochs instead of respawning them.
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
     )
     while True:
-        yield from iter(loader)
+        yield from loader
 
 
 def _seed_worker(worker_id: int):
@@ -96,60 +179,476 @@ def _seed_worker(worker_id: int):
 
 
 class StretchDataset(Dataset):
+    """
+    Each item is a tuple (image, ratio, blur_scale), where blur_scale is the
+    result of blur_scale() on the crop before it was downsampled.
+
+    :param draft: if True, let the JPEG decoder downscale images in the DCT
+                  domain to the smallest size that still covers every crop at
+                  the resolution the model needs. Crops are always chosen in
+                  original-image coordinates, so labels are unaffected.
+    :param cpu_augment: if True, blur and color jitter each image inside the
+                        worker. By default, training batches are instead
+                        augmented on-device by BatchAugment.
+    """
+
     def __init__(
-        self, directories: Sequence[str], valid: bool = False, num_valid: int = 10000
+        self,
+        directories: Sequence[str],
+        valid: bool = False,
+        num_valid: int = 10000,
+        draft: bool = True,
+        cpu_augment: bool = False,
     ):
-        self.image_paths = []
-        for directory in directories:
-            for root, _, files in os.walk(directory):
-                for file in files:
-                    if os.path.splitext(file)[1].lower() in {".jpg", ".jpeg"}:
-                        self.image_paths.append(os.path.join(root, file))
-        self.image_paths.sort()
-        random.Random(1337).shuffle(self.image_paths)
-        if valid:
-            self.image_paths = self.image_paths[:num_valid]
-        else:
-            self.image_paths = self.image_paths[num_valid:]
-        self.torchify = ToTensor()
-        self.augment = (
-            nn.Identity()
-            if valid
-            else nn.Sequential(
-                GaussianBlur(kernel_size=(3, 5), sigma=(0.1, 1.0)),
-                ColorJitter(brightness=0.2, hue=0.2),
-            )
+        self.image_paths = split_paths(
+            find_images(directories), valid=valid, num_valid=num_valid
         )
+        self.draft = draft
+        self.torchify = ToTensor()
+        self.augment = make_augment(cpu_augment and not valid)
 
     def __getitem__(self, index: int):
-        ImageFile.LOAD_TRUNCATED_IMAGES = True
+        img, ratio = self.load_crop(index)
+        scale = blur_scale(img)
+        img = self.augment(img)
+        return downsample_image(img), torch.tensor(ratio, dtype=torch.float32), scale
 
-        image = Image.open(self.image_paths[index]).convert("RGB")
-        image = random_crop(image)
+    def load_crop(self, index: int) -> Tuple[torch.Tensor, float]:
+        """
+        Decode and randomly crop an image, without augmenting or resizing it.
 
-        orig_shape = self.torchify(image).shape
-        ratio = orig_shape[1] / orig_shape[2]
+        :return: a tuple (image, ratio) of the crop and its aspect ratio.
+        """
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-        img = self.augment(self.torchify(image))
-        # Resizing with torch is and then average pooling is
-        # easier to emulate in JavaScript than resizing with
-        # Pillow's more sophisticated antialiasing.
-        img = F.interpolate(img[None], (128, 128), mode="bilinear")
-        img = F.avg_pool2d(img, 2, 2)[0]
+        image = Image.open(self.image_paths[index])
+        orig_width, orig_height = image.size
+        if self.draft:
+            image.draft("RGB", (DRAFT_SIZE, DRAFT_SIZE))
+        image = image.convert("RGB")
 
-        return img, torch.tensor(ratio, dtype=torch.float32)
+        box = random_crop_box(orig_width, orig_height)
+        _, _, crop_w, crop_h = box
+        ratio = crop_h / crop_w
+        image = image.crop(scale_crop_box(box, (orig_width, orig_height), image.size))
+        return self.torchify(image), ratio
 
     def __len__(self):
         return len(self.image_paths)
 
 
-def random_crop(image: Image.Image, min_frac: float = 0.9) -> Image.Image:
-    w, h = image.size
+class CachedStretchDataset(Dataset):
+    """
+    A drop-in replacement for StretchDataset which reads pre-decoded,
+    pre-resized images from a cache created by build_image_cache().
+
+    Crops are chosen in the coordinates of the original image, so the aspect
+    ratio labels follow exactly the same distribution as StretchDataset.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        valid: bool = False,
+        num_valid: int = 10000,
+        cpu_augment: bool = False,
+    ):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, CACHE_INDEX_NAME), "r") as f:
+            entries = json.load(f)
+        by_path = {entry["path"]: entry for entry in entries}
+        # Split before dropping skipped images, so that both datasets put
+        # every image in the same split.
+        paths = split_paths(sorted(by_path.keys()), valid=valid, num_valid=num_valid)
+        self.entries = [by_path[p] for p in paths if not by_path[p].get("skipped")]
+        self.augment = make_augment(cpu_augment and not valid)
+        # Opened lazily so that each worker process gets its own mapping.
+        self._data = None
+
+    def __getitem__(self, index: int):
+        if self._data is None:
+            self._data = np.memmap(
+                os.path.join(self.cache_dir, CACHE_DATA_NAME), dtype=np.uint8, mode="r"
+            )
+        entry = self.entries[index]
+        height, width = entry["height"], entry["width"]
+        orig_width, orig_height = entry["orig_width"], entry["orig_height"]
+        pixels = self._data[
+            entry["offset"] : entry["offset"] + height * width * 3
+        ].reshape(height, width, 3)
+
+        box = random_crop_box(orig_width, orig_height)
+        _, _, crop_w, crop_h = box
+        ratio = crop_h / crop_w
+
+        x0, y0, x1, y1 = scale_crop_box(box, (orig_width, orig_height), (width, height))
+        crop = np.array(pixels[y0:y1, x0:x1])
+
+        img = torch.from_numpy(crop).permute(2, 0, 1).float() / 255
+        scale = blur_scale(img)
+        img = self.augment(img)
+        return downsample_image(img), torch.tensor(ratio, dtype=torch.float32), scale
+
+    def __len__(self):
+        return len(self.entries)
+
+
+CACHE_DATA_NAME = "images.bin"
+CACHE_INDEX_NAME = "index.json"
+
+# Crops cover at least 90% of each side and are resized to 128x128 before
+# average pooling, so decoding at this size never loses needed resolution.
+DRAFT_SIZE = math.ceil(128 / 0.9)
+
+
+def build_image_cache(directories: Sequence[str], cache_dir: str, min_side: int = 256):
+    """
+    Decode every image once, shrink it so that its shortest side is at most
+    min_side, and store the raw RGB pixels in one flat uint8 file alongside a
+    JSON index recording offsets and original sizes.
+
+    Images that fail to decode stay in the index as skipped entries, so that
+    CachedStretchDataset splits the same list of paths as StretchDataset.
+    """
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entries = []
+    offset = 0
+    paths = find_images(directories)
+    with open(os.path.join(cache_dir, CACHE_DATA_NAME), "wb") as f:
+        for i, path in enumerate(paths):
+            try:
+                image = Image.open(path)
+                orig_width, orig_height = image.size
+                image.draft("RGB", (min_side, min_side))
+                image = image.convert("RGB")
+            except OSError as exc:
+                print(f"skipping {path}: {exc}")
+                entries.append(dict(path=path, skipped=True))
+                continue
+            width, height = image.size
+            scale = min_side / min(width, height)
+            if scale < 1:
+                image = image.resize(
+                    (
+                        max(1, round(width * scale)),
+                        max(1, round(height * scale)),
+                    ),
+                    Image.BICUBIC,
+                )
+            pixels = np.asarray(image, dtype=np.uint8)
+            f.write(pixels.tobytes())
+            entries.append(
+                dict(
+                    path=path,
+                    offset=offset,
+                    height=pixels.shape[0],
+                    width=pixels.shape[1],
+                    orig_height=orig_height,
+                    orig_width=orig_width,
+                )
+            )
+            offset += pixels.size
+            if (i + 1) % 1000 == 0:
+                print(f"cached {i + 1}/{len(paths)} images")
+    with open(os.path.join(cache_dir, CACHE_INDEX_NAME), "w") as f:
+        json.dump(entries, f)
+    num_cached = sum(not entry.get("skipped") for entry in entries)
+    print(f"cached {num_cached} images ({offset} bytes) to {cache_dir}")
+
+
+def find_images(directories: Sequence[str]) -> List[str]:
+    image_paths = []
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for file in files:
+                if os.path.splitext(file)[1].lower() in {".jpg", ".jpeg"}:
+                    image_paths.append(os.path.join(root, file))
+    image_paths.sort()
+    return image_paths
+
+
+def split_paths(paths: List[str], valid: bool, num_valid: int) -> List[str]:
+    paths = list(paths)
+    random.Random(1337).shuffle(paths)
+    if valid:
+        return paths[:num_valid]
+    else:
+        return paths[num_valid:]
+
+
+def make_augment(enabled: bool) -> nn.Module:
+    if not enabled:
+        return nn.Identity()
+    return nn.Sequential(
+        GaussianBlur(kernel_size=(3, 5), sigma=(0.1, 1.0)),
+        ColorJitter(brightness=0.2, hue=0.2),
+    )
+
+
+class BatchAugment(nn.Module):
+    """
+    A batched, on-device version of the augmentations from make_augment().
+
+    Each image gets its own blur sigma, brightness factor, hue shift and
+    order of color operations, sampled from the same distributions that
+    GaussianBlur and ColorJitter use.
+
+    make_augment() blurs crops at their decoded resolution, while this runs
+    after downsample_image(). Pass the blur_scale() of each crop as
+    sigma_scale so that the blur covers the same part of the image;
+    without it, sigma is measured in output pixels.
+    """
+
+    def __init__(
+        self,
+        kernel_size: Tuple[int, int] = (3, 5),
+        sigma: Tuple[float, float] = (0.1, 1.0),
+        brightness: float = 0.2,
+        hue: float = 0.2,
+    ):
+        super().__init__()
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.brightness = brightness
+        self.hue = hue
+
+    def forward(
+        self, images: torch.Tensor, sigma_scale: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        :param images: an [N x 3 x H x W] batch of images.
+        :param sigma_scale: an optional [N x 2] tensor of (x, y) factors to
+                            multiply each image's sampled sigma by.
+        """
+        return self.apply_params(
+            images,
+            **self.sample_params(len(images), images.device),
+            sigma_scale=sigma_scale,
+        )
+
+    def sample_params(self, n: int, device: torch.device) -> Dict[str, torch.Tensor]:
+        def uniform(low: float, high: float) -> torch.Tensor:
+            return torch.rand(n, device=device) * (high - low) + low
+
+        return dict(
+            sigma=uniform(*self.sigma),
+            brightness=uniform(1 - self.brightness, 1 + self.brightness),
+            hue=uniform(-self.hue, self.hue),
+            brightness_first=torch.rand(n, device=device) < 0.5,
+        )
+
+    def apply_params(
+        self,
+        images: torch.Tensor,
+        sigma: torch.Tensor,
+        brightness: torch.Tensor,
+        hue: torch.Tensor,
+        brightness_first: torch.Tensor,
+        sigma_scale: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        if sigma_scale is not None:
+            sigma = sigma[:, None] * sigma_scale
+        images = batch_gaussian_blur(images, self.kernel_size, sigma)
+        brightness = brightness[:, None, None, None]
+        hue = hue[:, None, None]
+        out_1 = batch_adjust_hue((images * brightness).clamp(0, 1), hue)
+        out_2 = (batch_adjust_hue(images, hue) * brightness).clamp(0, 1)
+        return torch.where(brightness_first[:, None, None, None], out_1, out_2)
+
+
+def batch_gaussian_blur(
+    images: torch.Tensor, kernel_size: Tuple[int, int], sigma: torch.Tensor
+) -> torch.Tensor:
+    """
+    Blur an [N x C x H x W] batch with a separable Gaussian kernel of size
+    (width, height), using a different sigma for every image.
+
+    :param sigma: an [N] tensor of sigmas, or an [N x 2] tensor of (x, y)
+                  sigmas.
+    """
+    n, c, h, w = images.shape
+    kx, ky = kernel_size
+    if sigma.ndim == 1:
+        sigma = sigma[:, None].expand(-1, 2)
+    sigma_x, sigma_y = sigma.unbind(-1)
+
+    def kernel_1d(size: int, sigma: torch.Tensor) -> torch.Tensor:
+        half = (size - 1) * 0.5
+        x = torch.linspace(-half, half, size, device=images.device)
+        pdf = torch.exp(-0.5 * (x / sigma[:, None]).pow(2))
+        kernel = pdf / pdf.sum(-1, keepdim=True)
+        return kernel.repeat_interleave(c, dim=0)
+
+    x = F.pad(images, [kx // 2, kx // 2, ky // 2, ky // 2], mode="reflect")
+    x = x.reshape(1, n * c, *x.shape[2:])
+    x = F.conv2d(x, kernel_1d(kx, sigma_x)[:, None, None, :], groups=n * c)
+    x = F.conv2d(x, kernel_1d(ky, sigma_y)[:, None, :, None], groups=n * c)
+    return x.reshape(n, c, h, w)
+
+
+def batch_adjust_hue(images: torch.Tensor, hue: torch.Tensor) -> torch.Tensor:
+    """
+    Shift the hue of an [N x 3 x H x W] batch of RGB images by an amount
+    broadcastable to [N x H x W], in units of full turns.
+    """
+    r, g, b = images.unbind(1)
+    max_c = images.max(1).values
+    min_c = images.min(1).values
+    eq_c = max_c == min_c
+    chroma = max_c - min_c
+    ones = torch.ones_like(max_c)
+    s = chroma / torch.where(eq_c, ones, max_c)
+    chroma_div = torch.where(eq_c, ones, chroma)
+    rc = (max_c - r) / chroma_div
+    gc = (max_c - g) / chroma_div
+    bc = (max_c - b) / chroma_div
+    hr = (max_c == r) * (bc - gc)
+    hg = ((max_c == g) & (max_c != r)) * (2.0 + rc - bc)
+    hb = ((max_c != g) & (max_c != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    h = torch.remainder(h + hue, 1.0)
+    v = max_c
+
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p = (v * (1.0 - s)).clamp(0, 1)
+    q = (v * (1.0 - s * f)).clamp(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0, 1)
+    choices = torch.stack(
+        [
+            torch.stack([v, q, p, p, t, v], dim=1),
+            torch.stack([t, v, v, q, p, p], dim=1),
+            torch.stack([p, p, t, v, v, q], dim=1),
+        ],
+        dim=1,
+    )
+    index = i[:, None, None].expand(-1, 3, 1, -1, -1)
+    return choices.gather(2, index)[:, :, 0]
+
+
+def check_batch_augment(dataset: StretchDataset, num_images: int):
+    """
+    Compare BatchAugment, with the same sampled parameters, against:
+
+     - the torchvision transforms applied one image at a time to the same
+       downsampled images, which should match up to float error;
+     - the old pipeline, which applies the torchvision transforms to each
+       crop at its decoded resolution before downsampling it. This differs
+       because blurring and color jitter do not commute exactly with
+       resizing.
+    """
+    torch.manual_seed(0)
+    np.random.seed(0)
+    crops = [dataset.load_crop(i)[0] for i in range(num_images)]
+    images = torch.stack([downsample_image(crop) for crop in crops])
+    scales = torch.stack([blur_scale(crop) for crop in crops])
+    augment = BatchAugment()
+    params = augment.sample_params(len(images), images.device)
+    actual = augment.apply_params(images, **params, sigma_scale=scales)
+
+    same_input = []
+    old_pipeline = []
+    for i, (image, crop) in enumerate(zip(images, crops)):
+        sigma = params["sigma"][i].item()
+        scaled_sigma = (sigma * scales[i]).tolist()
+        same_input.append(
+            _torchvision_augment(image, augment.kernel_size, params, i, scaled_sigma)
+        )
+        crop = _torchvision_augment(crop, augment.kernel_size, params, i, [sigma] * 2)
+        old_pipeline.append(downsample_image(crop))
+
+    for name, expected in [
+        ("torchvision", torch.stack(same_input)),
+        ("old pipeline", torch.stack(old_pipeline)),
+    ]:
+        diff = (actual - expected).abs()
+        print(f"{name}: max abs diff: {diff.max().item()}")
+        print(f"{name}: mean abs diff: {diff.mean().item()}")
+        print(
+            f"{name}: augmented mean: {actual.mean().item()}"
+            f" vs {expected.mean().item()}"
+        )
+        print(
+            f"{name}: augmented std: {actual.std().item()}"
+            f" vs {expected.std().item()}"
+        )
+
+
+def _torchvision_augment(
+    image: torch.Tensor,
+    kernel_size: Tuple[int, int],
+    params: Dict[str, torch.Tensor],
+    i: int,
+    sigma: List[float],
+) -> torch.Tensor:
+    image = TF.gaussian_blur(image, list(kernel_size), sigma)
+    ops = [
+        lambda x: TF.adjust_brightness(x, params["brightness"][i].item()),
+        lambda x: TF.adjust_hue(x, params["hue"][i].item()),
+    ]
+    if not params["brightness_first"][i].item():
+        ops = ops[::-1]
+    for op in ops:
+        image = op(image)
+    return image
+
+
+def downsample_image(img: torch.Tensor) -> torch.Tensor:
+    # Resizing with torch is and then average pooling is
+    # easier to emulate in JavaScript than resizing with
+    # Pillow's more sophisticated antialiasing.
+    img = F.interpolate(img[None], (128, 128), mode="bilinear")
+    return F.avg_pool2d(img, 2, 2)[0]
+
+
+def blur_scale(img: torch.Tensor) -> torch.Tensor:
+    """
+    Get the (x, y) factors by which downsample_image() shrinks distances in
+    a [C x H x W] image.
+    """
+    height, width = img.shape[-2:]
+    return torch.tensor([64 / width, 64 / height], dtype=torch.float32)
+
+
+def benchmark_dataset(dataset: Dataset, num_images: int) -> float:
+    """
+    Measure how many images per second a single worker can produce.
+    """
+    indices = np.random.permutation(len(dataset))[:num_images]
+    start = time.perf_counter()
+    for index in indices:
+        dataset[int(index)]
+    return len(indices) / (time.perf_counter() - start)
+
+
+def random_crop_box(w: int, h: int, min_frac: float = 0.9) -> Tuple[int, int, int, int]:
     new_h = np.random.randint(math.ceil(h * min_frac), h + 1)
     new_w = np.random.randint(math.ceil(w * min_frac), w + 1)
     new_y = np.random.randint(0, h - new_h + 1)
     new_x = np.random.randint(0, w - new_w + 1)
-    return image.crop((new_x, new_y, new_x + new_w, new_y + new_h))
+    return new_x, new_y, new_w, new_h
+
+
+def scale_crop_box(
+    box: Tuple[int, int, int, int],
+    orig_size: Tuple[int, int],
+    new_size: Tuple[int, int],
+) -> Tuple[int, int, int, int]:
+    """
+    Map an (x, y, w, h) crop box chosen on an image of orig_size onto a
+    resized copy of that image, returning (left, top, right, bottom).
+    """
+    x, y, crop_w, crop_h = box
+    (orig_width, orig_height), (width, height) = orig_size, new_size
+    scale_x, scale_y = width / orig_width, height / orig_height
+    x0 = min(width - 1, math.floor(x * scale_x))
+    y0 = min(height - 1, math.floor(y * scale_y))
+    x1 = max(x0 + 1, min(width, round((x + crop_w) * scale_x)))
+    y1 = max(y0 + 1, min(height, round((y + crop_h) * scale_y)))
+    return x0, y0, x1, y1
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1035 @@
+"""
+Recover rectangle poses from projected corners by sampling candidate
+solutions and refining them with gradient descent on the reprojection error.
+"""
+
+import time
+import warnings
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import torch
+import torch.nn as nn
+from torch.optim import Adam
+
+from .camera import Camera, Projection, euler_rotation
+from .checkpoint import is_inference_checkpoint, load_checkpoint, load_model_state
+from .data import Batch, corners_on_zplane
+from .gaussian_diffusion import GaussianDiffusion, diffusion_from_config
+from .model import (
+    DiffusionPrediction,
+    DiffusionPredictor,
+    DirectPredictor,
+    FusedDiffusionPredictor,
+    MixturePredictor,
+)
+from .weights import read_index
+
+DIFFUSION_SAMPLERS = ("ddpm", "ddim", "dpm2m", "dpm3m", "heun")
+SAMPLERS = ("prior", *DIFFUSION_SAMPLERS, "mdn")
+
+
+@dataclass
+class SolverProfile:
+    """
+    A named set of solver settings, as produced by flatten_torch.tune.
+    """
+
+    sampler: str = "ddpm"
+    steps: int = 128
+    num_candidates: int = 1000
+    iters: int = 1000
+    lr: float = 0.001
+    dedup_radius: Optional[float] = None
+    top_k: Optional[int] = None
+    halving_rounds: int = 1
+    guidance_scale: Optional[float] = None
+    early_exit_tol: Optional[float] = None
+    early_exit_loss: Optional[float] = None
+
+    @classmethod
+    def load(cls, path: str) -> "SolverProfile":
+        # Lazy import so that we only depend on yaml when loading profiles.
+        import yaml
+
+        with open(path, "rb") as f:
+            obj = yaml.load(f, Loader=yaml.SafeLoader)
+        return cls(**obj)
+
+    def save(self, path: str):
+        import yaml
+
+        with open(path, "w") as f:
+            yaml.safe_dump(asdict(self), f)
+
+
+@dataclass
+class Solution:
+    prediction: DiffusionPrediction  # [N x ...] best candidate per target
+    losses: torch.Tensor  # [N] reprojection loss of each best candidate
+
+
+def load_diffusion_predictor(
+    path: str, device: torch.device, use_ema: bool = True
+) -> DiffusionPredictor:
+    state_dict, metadata = load_checkpoint(path, device=device, use_ema=use_ema)
+    model = DiffusionPredictor(device=device, **(metadata.get("model_config") or {}))
+    load_model_state(model, state_dict, device=device)
+    return model
+
+
+def optimize_for_inference(
+    model: DiffusionPredictor, quantize: bool = False
+) -> FusedDiffusionPredictor:
+    """
+    Convert a trained model into an inference-only FusedDiffusionPredictor.
+
+    :param quantize: if True, also apply dynamic int8 quantization to the
+                     Linear layers that run once per row. Quantized models
+                     only run on the CPU. This uses torch.ao.quantization,
+                     which is deprecated in favor of the separate torchao
+                     package and will be dropped by a future torch release,
+                     at which point quantizing raises an ImportError.
+    """
+    fused = FusedDiffusionPredictor.from_model(model)
+    if quantize:
+        assert torch.device(model.device).type == "cpu", "quantization needs CPU"
+        # Lazy import so that we only depend on the deprecated quantization
+        # API when quantizing.
+        from torch.ao.quantization import quantize_dynamic
+
+        # The other branches run once per distinct timestep or condition, so
+        # quantizing them would cost accuracy for no speedup.
+        with warnings.catch_warnings():
+            # The deprecation is documented above, so don't repeat it on
+            # every call.
+            warnings.simplefilter("ignore", DeprecationWarning)
+            warnings.filterwarnings("ignore", message=".*quantized tensor creation")
+            fused = quantize_dynamic(
+                fused, {"input_embed", "backbone"}, dtype=torch.qint8
+            )
+    return fused
+
+
+def load_direct_predictor(
+    path: str, device: torch.device, use_ema: bool = True
+) -> DirectPredictor:
+    state_dict, _ = load_checkpoint(path, device=device, use_ema=use_ema)
+    model = DirectPredictor(device=device)
+    load_model_state(model, state_dict, device=device)
+    return model
+
+
+def load_mixture_predictor(
+    path: str, device: torch.device, use_ema: bool = True
+) -> MixturePredictor:
+    state_dict, _ = load_checkpoint(path, device=device, use_ema=use_ema)
+    model = MixturePredictor(device=device)
+    load_model_state(model, state_dict, device=device)
+    return model
+
+
+def load_diffusion_config(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Get the diffusion config stored in a diffusion checkpoint, or None for
+    checkpoints from before the config was saved.
+    """
+    if is_inference_checkpoint(path):
+        return read_index(path)[2].get("diffusion_config", None)
+    with open(path, "rb") as f:
+        obj = torch.load(f, map_location="cpu")
+    return obj.get("diffusion_config", None)
+
+
+def create_sampling_diffusion(
+    steps: int = 128, config: Optional[Dict[str, Any]] = None
+) -> GaussianDiffusion:
+    """
+    Create a respaced diffusion for sampling.
+
+    :param config: the training diffusion config, including any channel
+                   scales and biases. Defaults to the original linear
+                   schedule without normalization.
+    """
+    if config is None:
+        config = dict(schedule="linear", timesteps=1024)
+    return diffusion_from_config(dict(config, respacing=str(steps)))
+
+
+def project_prediction(pred: DiffusionPrediction) -> Projection:
+    camera = Camera(
+        rotation=euler_rotation(pred.rotation),
+        translation=pred.translation,
+        post_translation=pred.post_translation,
+    )
+    return camera.project(corners_on_zplane(pred.origin, pred.size))
+
+
+def reprojection_losses(
+    pred: DiffusionPrediction, targets: torch.Tensor
+) -> torch.Tensor:
+    """
+    :param pred: a batch of N predictions.
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :return: an [N] tensor of summed squared corner errors.
+    """
+    proj = project_prediction(pred).projected
+    return (proj - targets).pow(2).flatten(1).sum(-1)
+
+
+def corner_errors(pred: DiffusionPrediction, targets: torch.Tensor) -> torch.Tensor:
+    """
+    :return: an [N] tensor of the largest distance between any predicted
+             corner and its target.
+    """
+    proj = project_prediction(pred).projected
+    return (proj - targets).norm(dim=-1).max(-1).values
+
+
+class ReprojectionGuidance:
+    """
+    A cond_fn for the diffusion samplers which steers every denoising step
+    toward poses whose corners reproject onto the targets.
+
+    At each step, the model's x_0 prediction is moved down the gradient of
+    its reprojection loss, and the move is converted into the gradient with
+    respect to x_t that the samplers expect. For the samplers that condition
+    the score (DDIM, DPM-Solver++ and Heun), this shifts the x_0 prediction
+    by exactly -scale * grad (after clipping) at every step. DDPM instead
+    shifts the posterior mean by the gradient times the step's variance,
+    which for the posterior variance moves x_0 by
+    sqrt(alpha_t) * (1 - alpha_bar_{t-1}) / (1 - alpha_bar_t) times the step:
+    close to the full step at noisy steps, and shrinking to nothing at the
+    last, clean step. The network is treated as constant, so guidance costs
+    one extra forward pass per step but no backward pass through the
+    network.
+
+    :param model: the diffusion model being sampled.
+    :param diffusion: the diffusion being sampled from.
+    :param scale: the step size applied to the reprojection gradient.
+    :param max_step: the largest norm of the x_0 shift for any sample.
+    """
+
+    def __init__(
+        self,
+        model: DiffusionPredictor,
+        diffusion: GaussianDiffusion,
+        scale: float,
+        max_step: float = 1.0,
+    ):
+        self.model = model
+        self.diffusion = diffusion
+        self.scale = scale
+        self.max_step = max_step
+
+    def __call__(
+        self, x: torch.Tensor, t: torch.Tensor, cond: torch.Tensor
+    ) -> torch.Tensor:
+        step = self.xstart_step(x, t, cond)
+        # condition_score() moves x_0 by (1 - alpha_bar) / sqrt(alpha_bar)
+        # times the returned gradient, so this moves it by exactly step.
+        alpha_bar = torch.from_numpy(self.diffusion.alphas_cumprod).to(x)
+        alpha_bar = alpha_bar[self._respaced_steps(t)][:, None]
+        return step * alpha_bar.sqrt() / (1 - alpha_bar)
+
+    def xstart_step(
+        self, x: torch.Tensor, t: torch.Tensor, cond: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Compute the clipped shift that guidance applies to the model's x_0
+        prediction, in the diffusion's scaled space.
+
+        :param t: the original (unspaced) timesteps, as passed to cond_fn.
+        """
+        steps = self._respaced_steps(t)
+        with torch.no_grad():
+            eps = self.model(x, t, cond=cond)[:, : x.shape[1]]
+            pred_xstart = self.diffusion._predict_xstart_from_eps(x, steps, eps)
+        with torch.enable_grad():
+            pred_xstart.requires_grad_(True)
+            pred = DiffusionPrediction.from_vec(
+                self.diffusion.unscale_channels(pred_xstart)
+            )
+            # The model's condition is the flattened target corners.
+            losses = reprojection_losses(pred, cond.view(-1, 4, 2))
+            (grad,) = torch.autograd.grad(losses.sum(), pred_xstart)
+        step = -self.scale * grad
+        norms = step.norm(dim=-1, keepdim=True)
+        return step * (self.max_step / norms.clamp(min=1e-8)).clamp(max=1)
+
+    def _respaced_steps(self, t: torch.Tensor) -> torch.Tensor:
+        # Spaced diffusions pass cond_fn the original timesteps, but the
+        # diffusion coefficients are indexed by the respaced step.
+        timestep_map = getattr(self.diffusion, "timestep_map", None)
+        if timestep_map is None:
+            return t
+        return torch.searchsorted(torch.tensor(timestep_map, device=t.device), t)
+
+
+def sample_candidates(
+    targets: torch.Tensor,
+    num_candidates: int,
+    model: Optional[nn.Module] = None,
+    diffusion: Optional[GaussianDiffusion] = None,
+    sampler: str = "ddpm",
+    guidance_scale: Optional[float] = None,
+    early_exit_tol: Optional[float] = None,
+    early_exit_loss: Optional[float] = None,
+) -> DiffusionPrediction:
+    """
+    Produce initial guesses for each target.
+
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param num_candidates: the number of guesses per target.
+    :param model: the diffusion model, or a MixturePredictor for the "mdn"
+                  sampler. Required unless sampler is "prior".
+    :param diffusion: the diffusion process to sample with.
+    :param sampler: one of DIFFUSION_SAMPLERS to sample from the diffusion
+                    model, where "dpm2m" and "dpm3m" are the multistep
+                    DPM-Solver++ samplers and "heun" uses two model
+                    evaluations per step; "mdn" to draw all candidates from
+                    a MixturePredictor in one forward pass, or "prior" to
+                    draw random poses from the data distribution.
+    :param guidance_scale: if specified, steer the diffusion samplers with
+                           ReprojectionGuidance at this scale.
+    :param early_exit_tol: if specified, sample "ddim" with
+                           ddim_sample_loop_adaptive(), freezing candidates
+                           whose x_0 prediction moves less than this.
+    :param early_exit_loss: if specified, also freeze "ddim" candidates as
+                            soon as the reprojection loss of their x_0
+                            prediction is below this.
+    :return: a batch of N*num_candidates predictions, where the candidates
+             for each target are contiguous.
+    """
+    total = len(targets) * num_candidates
+    if sampler == "prior":
+        return DiffusionPrediction.from_batch(
+            Batch.sample_batch(total, device=targets.device)
+        )
+    elif sampler == "mdn":
+        assert model is not None, "a model is required"
+        with torch.no_grad():
+            return DiffusionPrediction.from_vec(
+                model.sample(targets.flatten(1), num_candidates)
+            )
+    assert model is not None and diffusion is not None, "a model is required"
+    kwargs = dict(
+        shape=(total, model.d_input),
+        device=targets.device,
+        clip_denoised=False,
+        model_kwargs=dict(cond=targets.flatten(1).repeat_interleave(num_candidates, 0)),
+    )
+    if guidance_scale is not None:
+        kwargs["cond_fn"] = ReprojectionGuidance(model, diffusion, scale=guidance_scale)
+    # Guidance needs autograd for its reprojection gradients; otherwise no
+    # sampler output needs to be tracked.
+    with torch.inference_mode(guidance_scale is None):
+        if sampler == "ddpm":
+            sample = diffusion.p_sample_loop(model, **kwargs)
+        elif sampler == "ddim" and (early_exit_tol, early_exit_loss) != (None, None):
+            sample = diffusion.ddim_sample_loop_adaptive(
+                model,
+                tol=early_exit_tol if early_exit_tol is not None else 0.0,
+                converged_fn=(
+                    None
+                    if early_exit_loss is None
+                    else _loss_converged_fn(
+                        targets.repeat_interleave(num_candidates, 0), early_exit_loss
+                    )
+                ),
+                **kwargs,
+            )["sample"]
+        elif sampler == "ddim":
+            sample = diffusion.ddim_sample_loop(model, **kwargs)
+        elif sampler == "dpm2m":
+            sample = diffusion.dpm_solver_sample_loop(model, order=2, **kwargs)
+        elif sampler == "dpm3m":
+            sample = diffusion.dpm_solver_sample_loop(model, order=3, **kwargs)
+        elif sampler == "heun":
+            sample = diffusion.heun_sample_loop(model, **kwargs)
+        else:
+            raise ValueError(f"unknown sampler: {sampler}")
+    # Clone to get a normal tensor that refinement can use with autograd.
+    return DiffusionPrediction.from_vec(sample.clone())
+
+
+def _loss_converged_fn(
+    targets: torch.Tensor, max_loss: float
+) -> Callable[[torch.Tensor, torch.Tensor], torch.Tensor]:
+    def converged_fn(pred_xstart: torch.Tensor, rows: torch.Tensor) -> torch.Tensor:
+        pred = DiffusionPrediction.from_vec(pred_xstart)
+        return reprojection_losses(pred, targets[rows]) < max_loss
+
+    return converged_fn
+
+
+def refine(
+    pred: DiffusionPrediction,
+    targets: torch.Tensor,
+    iters: int,
+    lr: float = 0.001,
+    callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+    deadline: Optional[float] = None,
+    keep_best: bool = False,
+) -> Tuple[DiffusionPrediction, torch.Tensor]:
+    """
+    Fine-tune predictions with Adam to minimize their reprojection loss.
+
+    The rectangle is constrained to the z=0 plane during optimization.
+
+    :param pred: a batch of N predictions.
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param iters: the number of optimization steps.
+    :param lr: the Adam learning rate.
+    :param callback: if specified, called as callback(step, losses) with the
+                     [N] losses before every step.
+    :param deadline: if specified, a synchronized_time() value after which
+                     to stop early.
+    :param keep_best: if True, return the lowest-loss state seen for each
+                      prediction rather than the final one.
+    :return: a tuple (refined, losses) where losses are the final [N]
+             reprojection losses.
+    """
+    origin = nn.Parameter(pred.origin[:, :2].detach().clone())
+    size = nn.Parameter(pred.size.detach().clone())
+    rotation = nn.Parameter(pred.rotation.detach().clone())
+    translation = nn.Parameter(pred.translation.detach().clone())
+    post_translation = nn.Parameter(pred.post_translation.detach().clone())
+    opt = Adam([origin, size, rotation, translation, post_translation], lr=lr)
+
+    def current() -> DiffusionPrediction:
+        return DiffusionPrediction(
+            origin=torch.cat([origin, torch.zeros_like(origin[:, :1])], dim=-1),
+            size=size,
+            rotation=rotation,
+            translation=translation,
+            post_translation=post_translation,
+        )
+
+    best_vecs, best_losses = None, None
+    for i in range(iters):
+        if deadline is not None and synchronized_time(targets.device) >= deadline:
+            break
+        losses = reprojection_losses(current(), targets)
+        if callback is not None:
+            callback(i, losses.detach())
+        if keep_best:
+            best_vecs, best_losses = _keep_best(
+                best_vecs, best_losses, current().to_vec().detach(), losses.detach()
+            )
+        opt.zero_grad()
+        losses.sum().backward()
+        opt.step()
+
+    with torch.no_grad():
+        result = DiffusionPrediction.from_vec(current().to_vec())
+        losses = reprojection_losses(result, targets)
+        if keep_best:
+            vecs, losses = _keep_best(best_vecs, best_losses, result.to_vec(), losses)
+            result = DiffusionPrediction.from_vec(vecs)
+        return result, losses
+
+
+def _keep_best(
+    best_vecs: Optional[torch.Tensor],
+    best_losses: Optional[torch.Tensor],
+    vecs: torch.Tensor,
+    losses: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    if best_vecs is None:
+        return vecs, losses
+    better = losses < best_losses
+    return (
+        torch.where(better[:, None], vecs, best_vecs),
+        torch.where(better, losses, best_losses),
+    )
+
+
+def synchronized_time(device: torch.device) -> float:
+    """
+    Get time.perf_counter() after waiting for queued work on the device.
+    """
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.perf_counter()
+
+
+def pose_features(
+    pred: DiffusionPrediction, reproj_weight: float = 1.0
+) -> torch.Tensor:
+    """
+    Embed predictions so that equivalent poses map to nearby points.
+
+    Different parameters can describe the same rectangle: the world frame can
+    be rotated or mirrored (e.g. with a negative size) while the camera moves
+    to compensate, and the whole scene can be scaled about the camera. The
+    rectangle's corners in camera space are unchanged by the former and only
+    scaled by the latter, so we use them normalized by their mean distance
+    to the camera, along with the 2D post-translation and the projected
+    corners themselves (weighted by reproj_weight).
+
+    :return: an [N x 22] tensor of features.
+    """
+    rotation = euler_rotation(pred.rotation)
+    corners = corners_on_zplane(pred.origin, pred.size)
+    cam_corners = torch.einsum("bjk,bnk->bnj", rotation, corners)
+    cam_corners = cam_corners + pred.translation[:, None]
+    scale = cam_corners.norm(dim=-1).mean(-1).clamp(min=1e-8)
+    proj = project_prediction(pred).projected
+    return torch.cat(
+        [
+            (cam_corners / scale[:, None, None]).flatten(1),
+            pred.post_translation,
+            proj.flatten(1) * reproj_weight,
+        ],
+        dim=-1,
+    )
+
+
+def cluster_candidates(
+    pred: DiffusionPrediction,
+    targets: torch.Tensor,
+    num_candidates: int,
+    radius: float = 0.05,
+    reproj_weight: float = 1.0,
+    max_per_cluster: int = 1,
+) -> torch.Tensor:
+    """
+    Greedily group near-duplicate candidates and choose representatives.
+
+    Candidates for each target are visited in order of increasing
+    reprojection loss. A candidate starts a new cluster unless it is within
+    radius (in pose_features() space) of an existing cluster's leader.
+
+    :param pred: candidates laid out as returned by sample_candidates().
+    :param targets: an [N*num_candidates x 4 x 2] tensor of targets.
+    :param max_per_cluster: the number of lowest-loss members to keep from
+                            each cluster.
+    :return: an [N*num_candidates] boolean mask of candidates to keep.
+    """
+    losses = reprojection_losses(pred, targets).nan_to_num(nan=float("inf"))
+    losses = losses.view(-1, num_candidates)
+    order = losses.argsort(dim=1)
+    feats = pose_features(pred, reproj_weight=reproj_weight).nan_to_num()
+    feats = feats.view(len(losses), num_candidates, -1)
+    feats = feats.gather(1, order[..., None].expand(-1, -1, feats.shape[-1]))
+    close = torch.cdist(feats, feats) < radius
+
+    leader = torch.zeros_like(close[:, 0])
+    for i in range(num_candidates):
+        leader[:, i] = ~(close[:, i] & leader).any(-1)
+
+    # Every candidate is close to itself, so leaders are their own cluster.
+    cluster = (close & leader[:, None]).float().argmax(-1)
+    same = cluster[:, :, None] == cluster[:, None, :]
+    earlier = torch.ones_like(same[0]).tril(-1)
+    rank = (same & earlier).sum(-1)
+    keep_sorted = rank < max_per_cluster
+
+    keep = torch.zeros_like(keep_sorted)
+    keep.scatter_(1, order, keep_sorted)
+    return keep.view(-1)
+
+
+def select_best(
+    pred: DiffusionPrediction,
+    losses: torch.Tensor,
+    owners: torch.Tensor,
+    num_targets: int,
+) -> Solution:
+    """
+    Pick the lowest-loss candidate for each target.
+
+    :param pred: a batch of candidates.
+    :param losses: the loss of each candidate.
+    :param owners: the index of the target that each candidate belongs to.
+    :param num_targets: the total number of targets.
+    """
+    losses = losses.nan_to_num(nan=float("inf"))
+    indices = torch.arange(len(losses), device=losses.device)
+    min_losses = torch.full(
+        (num_targets,), float("inf"), device=losses.device
+    ).scatter_reduce(0, owners, losses, reduce="amin")
+    is_min = losses == min_losses[owners]
+    rows = torch.full((num_targets,), len(losses), device=losses.device).scatter_reduce(
+        0, owners, torch.where(is_min, indices, len(losses)), reduce="amin"
+    )
+    return Solution(
+        prediction=DiffusionPrediction.from_vec(pred.to_vec()[rows]),
+        losses=losses[rows],
+    )
+
+
+def rank_within_targets(
+    losses: torch.Tensor, owners: torch.Tensor, num_targets: int
+) -> torch.Tensor:
+    """
+    Compute the rank of each candidate's loss among the candidates for the
+    same target, where 0 is the lowest loss.
+    """
+    losses = losses.nan_to_num(nan=float("inf"))
+    order = torch.argsort(losses, stable=True)
+    order = order[torch.argsort(owners[order], stable=True)]
+    counts = torch.bincount(owners, minlength=num_targets)
+    starts = counts.cumsum(0) - counts
+    ranks = torch.empty_like(order)
+    ranks[order] = torch.arange(len(order), device=order.device) - starts[owners[order]]
+    return ranks
+
+
+def refine_successive_halving(
+    pred: DiffusionPrediction,
+    targets: torch.Tensor,
+    owners: torch.Tensor,
+    num_targets: int,
+    iters: int,
+    rounds: int,
+    lr: float = 0.001,
+    callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+) -> Tuple[DiffusionPrediction, torch.Tensor, torch.Tensor]:
+    """
+    Refine candidates in equal-length rounds, dropping the worse half of each
+    target's candidates after every round but the last.
+
+    Each round starts a fresh optimizer from the surviving candidates.
+
+    :return: a tuple (refined, losses, owners) for the surviving candidates.
+    """
+    round_iters = [iters // rounds + (i < iters % rounds) for i in range(rounds)]
+    step = 0
+
+    def round_callback(i: int, losses: torch.Tensor):
+        if callback is not None:
+            callback(step + i, losses)
+
+    for i, num_iters in enumerate(round_iters):
+        pred, losses = refine(
+            pred, targets, iters=num_iters, lr=lr, callback=round_callback
+        )
+        step += num_iters
+        if i + 1 == rounds:
+            break
+        counts = torch.bincount(owners, minlength=num_targets)
+        ranks = rank_within_targets(losses, owners, num_targets)
+        keep = ranks < ((counts[owners] + 1) // 2)
+        pred = DiffusionPrediction.from_vec(pred.to_vec()[keep])
+        targets, owners = targets[keep], owners[keep]
+    return pred, losses, owners
+
+
+def solve(
+    targets: torch.Tensor,
+    *,
+    model: Optional[nn.Module] = None,
+    diffusion: Optional[GaussianDiffusion] = None,
+    sampler: str = "ddpm",
+    num_candidates: int = 1000,
+    iters: int = 1000,
+    lr: float = 0.001,
+    dedup_radius: Optional[float] = None,
+    top_k: Optional[int] = None,
+    halving_rounds: int = 1,
+    guidance_scale: Optional[float] = None,
+    early_exit_tol: Optional[float] = None,
+    early_exit_loss: Optional[float] = None,
+    callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+) -> Solution:
+    """
+    Sample candidates for every target, refine them, and keep the best one
+    per target.
+
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param dedup_radius: if specified, only refine one representative from
+                         each cluster of candidates found by
+                         cluster_candidates() with this radius.
+    :param top_k: if specified, only refine the top_k candidates per target
+                  with the lowest reprojection loss right after sampling.
+    :param halving_rounds: if greater than 1, split the iterations into this
+                           many rounds of successive halving.
+    :param guidance_scale: if specified, guide diffusion sampling toward the
+                           targets with ReprojectionGuidance, which usually
+                           allows far fewer refinement iterations.
+    :param early_exit_tol: see sample_candidates().
+    :param early_exit_loss: see sample_candidates().
+    """
+    candidates = sample_candidates(
+        targets,
+        num_candidates,
+        model=model,
+        diffusion=diffusion,
+        sampler=sampler,
+        guidance_scale=guidance_scale,
+        early_exit_tol=early_exit_tol,
+        early_exit_loss=early_exit_loss,
+    )
+    candidates, owners = prune_candidates(
+        candidates,
+        targets,
+        num_candidates,
+        dedup_radius=dedup_radius,
+        top_k=top_k,
+    )
+    if halving_rounds > 1:
+        refined, losses, owners = refine_successive_halving(
+            candidates,
+            targets[owners],
+            owners,
+            len(targets),
+            iters=iters,
+            rounds=halving_rounds,
+            lr=lr,
+            callback=callback,
+        )
+    else:
+        refined, losses = refine(
+            candidates,
+            targets[owners],
+            iters=iters,
+            lr=lr,
+            callback=callback,
+        )
+    return select_best(refined, losses, owners, len(targets))
+
+
+def prune_candidates(
+    candidates: DiffusionPrediction,
+    targets: torch.Tensor,
+    num_candidates: int,
+    dedup_radius: Optional[float] = None,
+    top_k: Optional[int] = None,
+) -> Tuple[DiffusionPrediction, torch.Tensor]:
+    """
+    Drop sampled candidates that are not worth refining.
+
+    :param candidates: num_candidates candidates for each of the N targets,
+                       grouped by target.
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param dedup_radius: see solve().
+    :param top_k: see solve().
+    :return: a tuple (candidates, owners), where owners gives the index of
+             the target of each remaining candidate.
+    """
+    owners = torch.arange(len(targets), device=targets.device)
+    owners = owners.repeat_interleave(num_candidates)
+    if dedup_radius is not None:
+        keep = cluster_candidates(
+            candidates, targets[owners], num_candidates, radius=dedup_radius
+        )
+        candidates = DiffusionPrediction.from_vec(candidates.to_vec()[keep])
+        owners = owners[keep]
+    if top_k is not None:
+        initial_losses = reprojection_losses(candidates, targets[owners])
+        keep = rank_within_targets(initial_losses, owners, len(targets)) < top_k
+        candidates = DiffusionPrediction.from_vec(candidates.to_vec()[keep])
+        owners = owners[keep]
+    return candidates, owners
+
+
+def refine_or_solve(
+    targets: torch.Tensor,
+    seeds: DiffusionPrediction,
+    mask: torch.Tensor,
+    *,
+    refine_iters: int,
+    accept_loss: float = 1e-6,
+    lr: float = 0.001,
+    **solve_kwargs,
+) -> Solution:
+    """
+    Refine initial guesses for some targets, and run solve() for the other
+    targets as well as for guesses which don't refine to accept_loss.
+
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param seeds: a batch of N initial guesses.
+    :param mask: an [N] boolean mask of which seeds to use.
+    :param refine_iters: the number of refinement steps for seeds.
+    :param solve_kwargs: arguments for solve() on the fallback path.
+    """
+    result_vecs = torch.zeros(len(targets), 13).to(targets)
+    result_losses = torch.full((len(targets),), float("inf"), device=targets.device)
+
+    if mask.any():
+        refined, losses = refine(
+            DiffusionPrediction.from_vec(seeds.to_vec()[mask]),
+            targets[mask],
+            iters=refine_iters,
+            lr=lr,
+        )
+        result_vecs[mask] = refined.to_vec()
+        result_losses[mask] = losses
+
+    todo = ~(result_losses <= accept_loss)
+    if todo.any():
+        solution = solve(targets[todo], lr=lr, **solve_kwargs)
+        better = solution.losses < result_losses[todo]
+        indices = todo.nonzero()[:, 0][better]
+        result_vecs[indices] = solution.prediction.to_vec()[better]
+        result_losses[indices] = solution.losses[better]
+
+    return Solution(
+        prediction=DiffusionPrediction.from_vec(result_vecs), losses=result_losses
+    )
+
+
+def solve_with_initializer(
+    targets: torch.Tensor,
+    initializer: DirectPredictor,
+    *,
+    init_iters: int = 200,
+    accept_loss: float = 1e-6,
+    lr: float = 0.001,
+    **solve_kwargs,
+) -> Solution:
+    """
+    Refine a single guess per target from a DirectPredictor, and only fall
+    back to solve() for targets where that guess doesn't converge.
+
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param init_iters: the number of refinement steps for the guesses.
+    :param accept_loss: the largest reprojection loss to accept.
+    :param solve_kwargs: arguments for solve() on the fallback path.
+    """
+    with torch.no_grad():
+        seeds = DiffusionPrediction.from_vec(initializer(targets.flatten(1)))
+    return refine_or_solve(
+        targets,
+        seeds,
+        torch.ones(len(targets), dtype=torch.bool, device=targets.device),
+        refine_iters=init_iters,
+        accept_loss=accept_loss,
+        lr=lr,
+        **solve_kwargs,
+    )
+
+
+def solve_sequence(
+    corners: torch.Tensor,
+    *,
+    track_iters: int = 50,
+    max_track_loss: float = 1e-6,
+    lr: float = 0.001,
+    callback: Optional[Callable[[int, bool], None]] = None,
+    **solve_kwargs,
+) -> Solution:
+    """
+    Solve a sequence of frames, such as a quad tracked through a video.
+
+    The first frame is solved with solve(). Every later frame is initialized
+    from the previous frame's solution, shifted by the motion of the quad's
+    centroid, and refined for track_iters steps. If that fails to reach
+    max_track_loss, the frame is solved from scratch with solve().
+
+    :param corners: a [T x 4 x 2] sequence of projected corners.
+    :param callback: if specified, called as callback(frame, tracked) after
+                     each frame, where tracked is False if the frame needed
+                     a full solve.
+    :param solve_kwargs: arguments for solve().
+    :return: a Solution with one prediction per frame.
+    """
+    first = solve(corners[:1], lr=lr, **solve_kwargs)
+    if callback is not None:
+        callback(0, False)
+    vecs = [first.prediction.to_vec()]
+    losses = [first.losses]
+    for i in range(1, len(corners)):
+        prev = DiffusionPrediction.from_vec(vecs[-1])
+        prev.post_translation = (
+            prev.post_translation + corners[i].mean(0) - corners[i - 1].mean(0)
+        )
+        pred, loss = refine(prev, corners[i : i + 1], iters=track_iters, lr=lr)
+        tracked = bool(loss.item() <= max_track_loss)
+        if not tracked:
+            solution = solve(corners[i : i + 1], lr=lr, **solve_kwargs)
+            if solution.losses.item() < loss.item():
+                pred, loss = solution.prediction, solution.losses
+        if callback is not None:
+            callback(i, tracked)
+        vecs.append(pred.to_vec())
+        losses.append(loss)
+    return Solution(
+        prediction=DiffusionPrediction.from_vec(torch.cat(vecs)),
+        losses=torch.cat(losses),
+    )
+
+
+@dataclass
+class CostModel:
+    """
+    A linear model of the solver's wall-clock cost on the current model and
+    hardware, in milliseconds.
+
+    Sampling costs sample_fixed_ms plus sample_row_ms per candidate, and
+    every refinement iteration costs refine_fixed_ms plus refine_row_ms per
+    candidate. The defaults are rough guesses; use measure() for real ones.
+    """
+
+    sample_fixed_ms: float = 10.0
+    sample_row_ms: float = 0.05
+    refine_fixed_ms: float = 1.0
+    refine_row_ms: float = 0.001
+
+    def sample_ms(self, rows: int) -> float:
+        return self.sample_fixed_ms + self.sample_row_ms * rows
+
+    def refine_ms(self, rows: int, iters: int) -> float:
+        return iters * (self.refine_fixed_ms + self.refine_row_ms * rows)
+
+    def max_rows(self, budget_ms: float, iters: int) -> int:
+        """
+        Get the most candidates which can be sampled and refined for iters
+        iterations within budget_ms.
+        """
+        spare = budget_ms - self.sample_fixed_ms - iters * self.refine_fixed_ms
+        per_row = self.sample_row_ms + iters * self.refine_row_ms
+        return max(0, int(spare / per_row))
+
+    def update_sample(self, rows: int, elapsed_ms: float, rate: float = 0.5):
+        """
+        Move the sampling cost toward an observed timing.
+        """
+        factor = self._correction(self.sample_ms(rows), elapsed_ms, rate)
+        self.sample_fixed_ms *= factor
+        self.sample_row_ms *= factor
+
+    def update_refine(
+        self, rows: int, iters: int, elapsed_ms: float, rate: float = 0.5
+    ):
+        """
+        Move the refinement cost toward an observed timing.
+        """
+        if iters == 0:
+            return
+        factor = self._correction(self.refine_ms(rows, iters), elapsed_ms, rate)
+        self.refine_fixed_ms *= factor
+        self.refine_row_ms *= factor
+
+    @staticmethod
+    def _correction(predicted_ms: float, elapsed_ms: float, rate: float) -> float:
+        return 1 + rate * (elapsed_ms / max(predicted_ms, 1e-8) - 1)
+
+    @classmethod
+    def measure(
+        cls,
+        device: torch.device,
+        row_counts: Tuple[int, int] = (16, 512),
+        iters: int = 20,
+        **sample_kwargs,
+    ) -> "CostModel":
+        """
+        Fit a cost model by timing sampling and refinement at two sizes.
+
+        :param row_counts: the two numbers of candidates to time.
+        :param iters: the number of refinement iterations to time.
+        :param sample_kwargs: model, diffusion and sampler arguments for
+                              sample_candidates().
+        """
+        targets = Batch.sample_batch(1, device=device).proj_corners
+        sample_times = []
+        refine_times = []
+        # Warm up, so that one-time setup costs don't end up in the fit.
+        refine(
+            sample_candidates(targets, row_counts[0], **sample_kwargs),
+            targets.repeat(row_counts[0], 1, 1),
+            iters=2,
+        )
+        for rows in row_counts:
+            start = synchronized_time(device)
+            pred = sample_candidates(targets, rows, **sample_kwargs)
+            mid = synchronized_time(device)
+            refine(pred, targets.repeat(rows, 1, 1), iters=iters)
+            end = synchronized_time(device)
+            sample_times.append((mid - start) * 1000)
+            refine_times.append((end - mid) * 1000 / iters)
+
+        def fit(times):
+            (r0, r1), (t0, t1) = row_counts, times
+            slope = max(0.0, (t1 - t0) / (r1 - r0))
+            return max(0.0, t0 - slope * r0), slope
+
+        sample_fixed_ms, sample_row_ms = fit(sample_times)
+        refine_fixed_ms, refine_row_ms = fit(refine_times)
+        return cls(
+            sample_fixed_ms=sample_fixed_ms,
+            sample_row_ms=max(sample_row_ms, 1e-6),
+            refine_fixed_ms=refine_fixed_ms,
+            refine_row_ms=max(refine_row_ms, 1e-6),
+        )
+
+
+def solve_anytime(
+    targets: torch.Tensor,
+    deadline_ms: float,
+    *,
+    cost_model: Optional[CostModel] = None,
+    max_candidates: int = 1000,
+    min_iters: int = 50,
+    max_iters: int = 1000,
+    lr: float = 0.001,
+    safety: float = 0.9,
+    dedup_radius: Optional[float] = None,
+    top_k: Optional[int] = None,
+    callback: Optional[Callable[[int, torch.Tensor], None]] = None,
+    **sample_kwargs,
+) -> Solution:
+    """
+    Solve targets within a wall-clock budget, returning the best solution
+    found when time runs out.
+
+    The number of candidates is the largest that the cost model predicts
+    can be sampled and refined for min_iters iterations within the budget.
+    Refinement then continues until max_iters or the deadline, and keeps the
+    best state seen for every candidate. The cost model is updated with the
+    timings of this call, so passing the same instance to later calls keeps
+    it calibrated.
+
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param deadline_ms: the time budget, measured from the start of the call.
+    :param cost_model: the cost model to plan with and update.
+    :param safety: the fraction of the budget to plan for, leaving the rest
+                   for the final selection and for timing noise.
+    :param dedup_radius: see solve(). Pruning happens after the budget is
+                         planned, so it only frees up time for refinement.
+    :param top_k: see solve().
+    :param sample_kwargs: arguments for sample_candidates(), such as model,
+                          diffusion, sampler and guidance_scale.
+    """
+    device = targets.device
+    start = synchronized_time(device)
+    deadline = start + deadline_ms / 1000
+    if cost_model is None:
+        cost_model = CostModel()
+
+    rows = cost_model.max_rows(deadline_ms * safety, min_iters)
+    num_candidates = min(max_candidates, max(1, rows // len(targets)))
+    candidates = sample_candidates(targets, num_candidates, **sample_kwargs)
+    sampled = synchronized_time(device)
+    total = len(targets) * num_candidates
+    cost_model.update_sample(total, (sampled - start) * 1000)
+
+    # The time spent pruning is charged to refinement, which it speeds up.
+    candidates, owners = prune_candidates(
+        candidates, targets, num_candidates, dedup_radius=dedup_radius, top_k=top_k
+    )
+    kept = len(owners)
+
+    steps = [0]
+
+    def count_steps(i: int, losses: torch.Tensor):
+        steps[0] = i + 1
+        if callback is not None:
+            callback(i, losses)
+
+    reserve = cost_model.refine_ms(kept, 1) / 1000 + deadline_ms * (1 - safety) / 1000
+    refined, losses = refine(
+        candidates,
+        targets[owners],
+        iters=max_iters,
+        lr=lr,
+        callback=count_steps,
+        deadline=deadline - reserve,
+        keep_best=True,
+    )
+    cost_model.update_refine(
+        kept, steps[0], (synchronized_time(device) - sampled) * 1000
+    )
+    return select_best(refined, losses, owners, len(targets))
@@ -0,0 +1,120 @@
+"""
+Find cost-optimal solver settings by sweeping benchmark configurations.
+
+Usage:
+
+    python -m flatten_torch.tune --checkpoint diffusion_model.pt \\
+        --steps 16,32,64,128 --candidates 16,64,256,1000 --iters 50,200,1000 \\
+        --profile_out solver_profile.yaml
+
+The resulting profile can be passed to the solver entry points with
+--profile solver_profile.yaml.
+"""
+
+import argparse
+from typing import List, Optional
+
+from .bench import (
+    BenchResult,
+    add_bench_args,
+    format_result,
+    load_results,
+    run_bench,
+    save_results,
+)
+from .solver import SolverProfile
+
+OBJECTIVES = ("latency", "throughput")
+
+
+def pareto_frontier(
+    results: List[BenchResult], objective: str = "latency"
+) -> List[BenchResult]:
+    """
+    Get the results which are not beaten in both cost and success rate by
+    any other result, sorted from cheapest to most expensive.
+
+    :param objective: "latency" to measure cost as single-target latency, or
+                      "throughput" to measure it as time per batched target.
+    """
+    ordered = sorted(
+        results, key=lambda r: (result_cost(r, objective), -r.success_rate)
+    )
+    frontier = []
+    for result in ordered:
+        if not frontier or result.success_rate > frontier[-1].success_rate:
+            frontier.append(result)
+    return frontier
+
+
+def result_cost(result: BenchResult, objective: str) -> float:
+    if objective == "latency":
+        return result.latency_ms
+    elif objective == "throughput":
+        return 1000 / result.throughput
+    else:
+        raise ValueError(f"unknown objective: {objective}")
+
+
+def recommend(
+    frontier: List[BenchResult], min_success_frac: float = 0.99
+) -> Optional[BenchResult]:
+    """
+    Pick the cheapest frontier point whose success rate is within a factor
+    of min_success_frac of the best success rate.
+    """
+    if not frontier:
+        return None
+    best_success = max(r.success_rate for r in frontier)
+    for result in frontier:
+        if result.success_rate >= best_success * min_success_frac:
+            return result
+    return frontier[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_bench_args(parser)
+    parser.add_argument("--results", type=str, default=None)
+    parser.add_argument("--results_out", type=str, default="tune_results.json")
+    parser.add_argument("--objective", type=str, default="latency", choices=OBJECTIVES)
+    parser.add_argument("--min_success_frac", type=float, default=0.99)
+    parser.add_argument("--profile_out", type=str, default="solver_profile.yaml")
+    args = parser.parse_args()
+
+    if args.results is not None:
+        results = load_results(args.results)
+    else:
+        results = run_bench(args)
+        save_results(args.results_out, results)
+        print(f"saved results to {args.results_out}")
+
+    frontier = pareto_frontier(results, objective=args.objective)
+    print("pareto frontier:")
+    for result in frontier:
+        print(format_result(result))
+
+    best = recommend(frontier, min_success_frac=args.min_success_frac)
+    if best is None:
+        print("no results to choose a profile from")
+        return
+    profile = SolverProfile(
+        sampler=best.config.sampler,
+        steps=best.config.steps,
+        num_candidates=best.config.num_candidates,
+        iters=best.config.iters,
+        lr=args.lr,
+        dedup_radius=best.config.dedup_radius,
+        top_k=best.config.top_k,
+        halving_rounds=best.config.halving_rounds,
+        guidance_scale=best.config.guidance_scale,
+        early_exit_tol=best.config.early_exit_tol,
+        early_exit_loss=best.config.early_exit_loss,
+    )
+    profile.save(args.profile_out)
+    print(f"recommended: {format_result(best)}")
+    print(f"saved profile to {args.profile_out}")
+
+
+if __name__ == "__main__":
+    main()
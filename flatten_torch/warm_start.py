@@ -0,0 +1,230 @@
+"""
+Reuse recent solutions to skip diffusion sampling for similar inputs.
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+
+from .camera import euler_rotation, rotation_to_euler
+from .model import DiffusionPrediction
+from .solver import Solution, project_prediction, refine_or_solve
+
+
+def canonicalize_corners(
+    corners: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    Remove the position, scale and starting corner from a batch of quads.
+
+    :param corners: an [N x 4 x 2] batch of projected corners.
+    :return: a tuple (canonical, shifts, centroids, scales). The canonical
+             corners are centered, divided by their RMS radius (the scale),
+             and cyclically rotated so that canonical corner i is input
+             corner (i + shift) % 4, where the first canonical corner is the
+             one closest to the top-left.
+    """
+    centroids = corners.mean(1)
+    centered = corners - centroids[:, None]
+    scale = centered.pow(2).sum(-1).mean(-1).sqrt().clamp(min=1e-8)
+    normalized = centered / scale[:, None, None]
+    shifts = corners.sum(-1).argmin(-1)
+    indices = (torch.arange(4, device=corners.device) + shifts[:, None]) % 4
+    canonical = normalized.gather(1, indices[..., None].expand(-1, -1, 2))
+    return canonical, shifts, centroids, scale
+
+
+def shift_pose_corners(pred: DiffusionPrediction, shifts: torch.Tensor):
+    """
+    Re-parameterize poses so that corner i of the result is corner
+    (i + shift) % 4 of the input, without changing the projected quad.
+
+    Each shift by one corner moves the world origin to the old second corner
+    and rotates the world frame by 90 degrees about z, which the camera
+    rotation and translation absorb.
+
+    :param pred: a batch of N predictions.
+    :param shifts: an [N] tensor of shifts.
+    """
+    shifts = shifts % 4
+    rz = torch.tensor(
+        [[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]],
+        device=pred.origin.device,
+        dtype=pred.origin.dtype,
+    )
+    for step in range(3):
+        mask = (shifts > step)[:, None]
+        if not mask.any():
+            break
+        rotation = euler_rotation(pred.rotation)
+        width, height = pred.size.unbind(-1)
+        second = pred.origin + torch.stack(
+            [width, torch.zeros_like(width), torch.zeros_like(width)], dim=-1
+        )
+        shifted = DiffusionPrediction(
+            origin=torch.zeros_like(pred.origin),
+            size=torch.stack([height, width], dim=-1),
+            rotation=rotation_to_euler(rotation @ rz),
+            translation=pred.translation + torch.einsum("bjk,bk->bj", rotation, second),
+            post_translation=pred.post_translation,
+        )
+        pred = DiffusionPrediction.from_vec(
+            torch.where(mask, shifted.to_vec(), pred.to_vec())
+        )
+    return pred
+
+
+class WarmStartCache:
+    """
+    An LRU cache of recent solutions, keyed on canonicalized corners.
+
+    Solutions are stored in canonical corner order. On a hit, the cached pose
+    is re-ordered to match the query, its camera translation is divided by
+    the ratio of the query and cached scales, and it is shifted so that its
+    projected centroid lands on the query's. This is exact when the quads
+    differ only by a translation and close for small changes of scale, as
+    long as the quad is far from the camera relative to its size; refinement
+    handles any remaining difference.
+
+    :param capacity: the maximum number of solutions to keep.
+    :param max_distance: the largest RMS distance between canonical corners
+                         that still counts as a hit.
+    """
+
+    def __init__(self, capacity: int = 1024, max_distance: float = 0.05):
+        self.capacity = capacity
+        self.max_distance = max_distance
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 0
+        self._index: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._index = None
+
+    def insert(
+        self,
+        corners: torch.Tensor,
+        pred: DiffusionPrediction,
+        entry_ids: Optional[torch.Tensor] = None,
+    ):
+        """
+        Add solutions for an [N x 4 x 2] batch of corners.
+
+        :param entry_ids: an optional [N] tensor of entry ids from lookup().
+                          Rows with an id still in the cache replace that
+                          entry and mark it as recently used, rather than
+                          adding a near-duplicate; rows with id -1 are added.
+        """
+        canonical, shifts, _, scales = canonicalize_corners(corners)
+        canonical_pred = shift_pose_corners(pred, shifts)
+        vecs = canonical_pred.to_vec().detach()
+        if entry_ids is None:
+            entry_ids = torch.full((len(corners),), -1, dtype=torch.long)
+        for entry_id, key, scale, vec in zip(
+            entry_ids.tolist(), canonical, scales, vecs
+        ):
+            entry = dict(key=key.flatten(), scale=scale, vec=vec)
+            if entry_id in self._entries:
+                self._entries[entry_id] = entry
+                self._entries.move_to_end(entry_id)
+            else:
+                self._entries[self._next_id] = entry
+                self._next_id += 1
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+        self._index = None
+
+    def lookup(
+        self, corners: torch.Tensor
+    ) -> Tuple[DiffusionPrediction, torch.Tensor, torch.Tensor]:
+        """
+        Find the nearest cached solution for each of N targets.
+
+        :return: a tuple (pred, hits, entry_ids) where pred is a batch of N
+                 seeds, hits is an [N] boolean mask, and entry_ids is an [N]
+                 tensor of the ids of the matched entries, for insert().
+                 Seeds for misses are meaningless, and their ids are -1.
+        """
+        canonical, shifts, centroids, scales = canonicalize_corners(corners)
+        num = len(corners)
+        if not self._entries:
+            vecs = torch.zeros(num, 13, device=corners.device, dtype=corners.dtype)
+            return (
+                DiffusionPrediction.from_vec(vecs),
+                torch.zeros(num, dtype=torch.bool, device=corners.device),
+                torch.full((num,), -1, dtype=torch.long),
+            )
+
+        ids, keys = self._get_index()
+        dists = torch.cdist(canonical.flatten(1), keys.to(canonical)) / 2
+        min_dists, nearest = dists.min(-1)
+        hits = min_dists <= self.max_distance
+
+        entry_ids = torch.where(hits.cpu(), ids[nearest.cpu()], -1)
+        entries = [self._entries[ids[i].item()] for i in nearest.tolist()]
+        for entry_id in entry_ids.tolist():
+            if entry_id >= 0:
+                self._entries.move_to_end(entry_id)
+        vecs = torch.stack([e["vec"] for e in entries]).to(corners)
+        cached_scales = torch.stack([e["scale"] for e in entries]).to(corners)
+        pred = shift_pose_corners(DiffusionPrediction.from_vec(vecs), -shifts)
+        # Moving the pose toward the camera by the scale ratio enlarges its
+        # projection by about that ratio, under weak perspective.
+        pred.translation = pred.translation * (cached_scales / scales)[:, None]
+        projected = project_prediction(pred).projected.mean(1)
+        pred.post_translation = pred.post_translation + centroids - projected
+        return pred, hits, entry_ids
+
+    def _get_index(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self._index is None:
+            ids = torch.tensor(list(self._entries.keys()))
+            keys = torch.stack([e["key"] for e in self._entries.values()])
+            self._index = (ids, keys)
+        return self._index
+
+
+def solve_with_cache(
+    targets: torch.Tensor,
+    cache: WarmStartCache,
+    *,
+    warm_iters: int = 100,
+    accept_loss: float = 1e-6,
+    lr: float = 0.001,
+    **solve_kwargs,
+) -> Solution:
+    """
+    Solve targets by refining cached solutions where possible, and fall back
+    to solve() for misses and for warm starts that fail to converge.
+
+    :param targets: an [N x 4 x 2] batch of projected corners.
+    :param cache: the cache to read from, and to update with every result
+                  that reaches accept_loss. Results for hits refresh the
+                  entry they were seeded from.
+    :param warm_iters: the number of refinement steps for warm starts.
+    :param accept_loss: the largest reprojection loss at which a warm start
+                        is accepted.
+    :param solve_kwargs: arguments for solve() on the fallback path.
+    """
+    seeds, hits, entry_ids = cache.lookup(targets)
+    solution = refine_or_solve(
+        targets,
+        seeds,
+        hits,
+        refine_iters=warm_iters,
+        accept_loss=accept_loss,
+        lr=lr,
+        **solve_kwargs,
+    )
+    solved = solution.losses <= accept_loss
+    if solved.any():
+        cache.insert(
+            targets[solved],
+            DiffusionPrediction.from_vec(solution.prediction.to_vec()[solved]),
+            entry_ids=entry_ids[solved.cpu()],
+        )
+    return solution
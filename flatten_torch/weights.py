@@ -0,0 +1,204 @@
+"""
+Reading and writing the flat binary weight format used by the web demo.
+
+A file starts with a little-endian uint32 giving the size of a JSON header,
+followed by the header and then the raw tensor data.
+
+The original (version 1) header is a list of [name, shape] pairs, and every
+tensor is stored as consecutive little-endian float32 values. This is the
+only format understood by src/model.ts.
+
+Version 2 headers are a dict with a list of tensors, each recording its
+name, shape, storage dtype, and byte offset into the data section. Tensors
+may be stored as float32, float16, or int8 with one float32 scale per
+output channel (the first dimension), kept in the header. The header may
+also carry a dict of JSON metadata, and is padded so that the data section
+and every tensor in it start on a DATA_ALIGNMENT boundary, which lets
+readers map tensors directly from the file.
+
+This module only depends on numpy so that it can be used without torch.
+"""
+
+import json
+import os
+import struct
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+import numpy as np
+
+STORAGE_DTYPES = ("float32", "float16", "int8")
+DATA_ALIGNMENT = 8
+
+# Entries of a diffusion_config in the metadata that normalize the channels
+# of the model's targets. They are never stored as tensors.
+CHANNEL_KEYS = ("channel_scales", "channel_biases")
+
+
+def write_weights(
+    f: BinaryIO,
+    state_dict: Dict[str, np.ndarray],
+    dtype: str = "float32",
+    metadata: Optional[Dict[str, Any]] = None,
+):
+    """
+    Write a dict of float arrays to a file.
+
+    :param f: the binary file to write to.
+    :param state_dict: a mapping from names to numpy arrays.
+    :param dtype: the storage dtype. If "float32" and there is no metadata,
+                  the version 1 format is written for compatibility with
+                  the browser loader.
+                  For "int8", tensors with fewer than two dimensions (such
+                  as biases) are kept in float32.
+    :param metadata: if specified, a JSON-serializable dict to store in the
+                     header, which forces the version 2 format.
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"unknown storage dtype: {dtype}")
+
+    if dtype == "float32" and metadata is None:
+        header = [(k, list(v.shape)) for k, v in state_dict.items()]
+        _write_header(f, header)
+        for v in state_dict.values():
+            f.write(np.ascontiguousarray(v, dtype="<f4").tobytes())
+        return
+
+    tensors = []
+    buffers = []
+    offset = 0
+    for name, value in state_dict.items():
+        value = np.asarray(value, dtype=np.float32)
+        info = dict(name=name, shape=list(value.shape), offset=offset)
+        if dtype == "int8" and value.ndim >= 2:
+            data, scales = quantize_int8(value)
+            info["dtype"] = "int8"
+            info["scales"] = scales.tolist()
+        elif dtype == "float16":
+            data = value.astype("<f2")
+            info["dtype"] = "float16"
+        else:
+            data = value.astype("<f4")
+            info["dtype"] = "float32"
+        raw = data.tobytes()
+        padding = -len(raw) % DATA_ALIGNMENT
+        buffers.append(raw + b"\0" * padding)
+        offset += len(raw) + padding
+        tensors.append(info)
+
+    header = dict(version=2, tensors=tensors)
+    if metadata is not None:
+        header["metadata"] = metadata
+    _write_header(f, header, alignment=DATA_ALIGNMENT)
+    for raw in buffers:
+        f.write(raw)
+
+
+def read_weights(path: str, mmap: bool = False) -> Dict[str, np.ndarray]:
+    """
+    Read a weight file written by write_weights() as float32 arrays.
+
+    :param path: the path to the file.
+    :param mmap: if True, memory-map the file rather than reading it. For
+                 float32 tensors, the returned arrays are then read-only
+                 views into the mapping.
+    """
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode="r")
+    else:
+        with open(path, "rb") as f:
+            buf = np.frombuffer(f.read(), dtype=np.uint8)
+    header, data_start = _read_header(buf)
+    data = buf[data_start:]
+
+    result = {}
+    for info in _tensor_infos(header):
+        shape = tuple(info["shape"])
+        count = int(np.prod(shape))
+        dtype = np.dtype(info["dtype"]).newbyteorder("<")
+        start = info["offset"]
+        raw = data[start : start + count * dtype.itemsize]
+        arr = np.frombuffer(raw, dtype=dtype).reshape(shape)
+        if info["dtype"] == "int8":
+            scales = np.array(info["scales"], dtype=np.float32)
+            arr = dequantize_int8(arr, scales)
+        elif info["dtype"] != "float32":
+            arr = arr.astype(np.float32)
+        result[info["name"]] = arr
+    return result
+
+
+def read_index(path: str) -> Tuple[List[Dict[str, Any]], int, Dict[str, Any]]:
+    """
+    Read the header of a weight file without reading any tensor data.
+
+    :return: a tuple (tensors, data_start, metadata). Each tensor is a dict
+             with its name, shape, storage dtype, and byte offset into the
+             data section (plus scales for int8). data_start is the byte
+             offset of the data section in the file, and metadata is empty
+             for files without any.
+    """
+    with open(path, "rb") as f:
+        (size,) = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(size).decode("utf-8"))
+    metadata = {} if isinstance(header, list) else header.get("metadata", {})
+    return _tensor_infos(header), 4 + size, metadata
+
+
+def is_weight_file(path: str) -> bool:
+    """
+    Check if a file looks like it was written by write_weights(), rather
+    than by torch.save().
+    """
+    with open(path, "rb") as f:
+        prefix = f.read(5)
+    if len(prefix) < 5:
+        return False
+    (size,) = struct.unpack("<I", prefix[:4])
+    return prefix[4:] in (b"[", b"{") and 4 + size <= os.path.getsize(path)
+
+
+def quantize_int8(value: np.ndarray):
+    """
+    Symmetrically quantize an array to int8 with one scale per index of the
+    first dimension.
+
+    :return: a tuple (quantized, scales).
+    """
+    flat = value.reshape(len(value), -1)
+    scales = np.abs(flat).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.round(flat / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized.reshape(value.shape), scales.astype(np.float32)
+
+
+def dequantize_int8(quantized: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    shape = [len(scales)] + [1] * (quantized.ndim - 1)
+    return quantized.astype(np.float32) * scales.reshape(shape)
+
+
+def _write_header(f: BinaryIO, header: Any, alignment: int = 1):
+    metadata = bytes(json.dumps(header), "utf-8")
+    # Trailing whitespace is valid JSON, so it can pad the header.
+    metadata += b" " * (-(4 + len(metadata)) % alignment)
+    f.write(struct.pack("<I", len(metadata)))
+    f.write(metadata)
+
+
+def _read_header(buf: np.ndarray):
+    (size,) = struct.unpack("<I", bytes(buf[:4]))
+    header = json.loads(bytes(buf[4 : 4 + size]).decode("utf-8"))
+    return header, 4 + size
+
+
+def _tensor_infos(header: Any) -> List[Dict[str, Any]]:
+    if isinstance(header, list):
+        infos = []
+        offset = 0
+        for name, shape in header:
+            infos.append(dict(name=name, shape=shape, dtype="float32", offset=offset))
+            offset += int(np.prod(shape)) * 4
+        return infos
+    version: Optional[int] = header.get("version")
+    if version != 2:
+        raise ValueError(f"unsupported weight file version: {version}")
+    return header["tensors"]
@@ -30,19 +30,7 @@ class DiffusionModel {
             new ReLU(),
             new Linear(this.params["input_embed.2.weight"], this.params["input_embed.2.bias"]),
         ]);
-        this.backbone = new Sequential([
-            new Linear(this.params["backbone.0.weight"], this.params["backbone.0.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.2.weight"], this.params["backbone.2.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.4.weight"], this.params["backbone.4.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.6.weight"], this.params["backbone.6.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.8.weight"], this.params["backbone.8.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.10.weight"], this.params["backbone.10.bias"]),
-        ]);
+        this.backbone = new Sequential(linearLayers(this.params, "backbone"));
     }
     static load(path) {
         return __awaiter(this, void 0, void 0, function* () {
@@ -57,6 +45,23 @@ class DiffusionModel {
         return this.backbone.forward(combined);
     }
 }
+function linearLayers(params, prefix) {
+    const indices = Object.keys(params)
+        .filter((name) => name.startsWith(prefix + ".") && name.endsWith(".weight"))
+        .map((name) => parseInt(name.split(".")[1]))
+        .sort((a, b) => a - b);
+    if (!indices.length) {
+        throw new Error(`no layers found for ${prefix}`);
+    }
+    const layers = [];
+    indices.forEach((index, i) => {
+        if (i > 0) {
+            layers.push(new ReLU());
+        }
+        layers.push(new Linear(params[`${prefix}.${index}.weight`], params[`${prefix}.${index}.bias`]));
+    });
+    return layers;
+}
 function timestepEmbedding(timesteps, dim) {
     const maxPeriod = 10000;
     const range = Tensor.zeros(Shape.make(1, dim / 2));
@@ -147,6 +152,9 @@ function readParamDict(url) {
         const bytes = new Uint8Array(buf);
         const metadataSize = bytes[0] | (bytes[1] << 8) | (bytes[2] << 16) | (bytes[3] << 24);
         const metadata = JSON.parse(String.fromCharCode.apply(null, bytes.slice(4, 4 + metadataSize)));
+        if (!Array.isArray(metadata)) {
+            throw new Error(`unsupported weight file format: ${url}`);
+        }
         let allData = new Float32Array(flipToLittleEndian(buf.slice(4 + metadataSize)));
         const stateDict = {};
         metadata.forEach((info) => {
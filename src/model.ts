@@ -30,19 +30,8 @@ class DiffusionModel {
             new ReLU(),
             new Linear(this.params["input_embed.2.weight"], this.params["input_embed.2.bias"]),
         ]);
-        this.backbone = new Sequential([
-            new Linear(this.params["backbone.0.weight"], this.params["backbone.0.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.2.weight"], this.params["backbone.2.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.4.weight"], this.params["backbone.4.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.6.weight"], this.params["backbone.6.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.8.weight"], this.params["backbone.8.bias"]),
-            new ReLU(),
-            new Linear(this.params["backbone.10.weight"], this.params["backbone.10.bias"]),
-        ]);
+        // The depth varies between models, so take it from the header.
+        this.backbone = new Sequential(linearLayers(this.params, "backbone"));
     }
 
     static async load(path: string): Promise<DiffusionModel> {
@@ -58,6 +47,24 @@ class DiffusionModel {
     }
 }
 
+function linearLayers(params: ParamDict, prefix: string): TensorLayer[] {
+    const indices = Object.keys(params)
+        .filter((name) => name.startsWith(prefix + ".") && name.endsWith(".weight"))
+        .map((name) => parseInt(name.split(".")[1]))
+        .sort((a, b) => a - b);
+    if (!indices.length) {
+        throw new Error(`no layers found for ${prefix}`);
+    }
+    const layers: TensorLayer[] = [];
+    indices.forEach((index, i) => {
+        if (i > 0) {
+            layers.push(new ReLU());
+        }
+        layers.push(new Linear(params[`${prefix}.${index}.weight`], params[`${prefix}.${index}.bias`]));
+    });
+    return layers;
+}
+
 function timestepEmbedding(timesteps: Tensor, dim: number) {
     const maxPeriod = 10000;
     const range = Tensor.zeros(Shape.make(1, dim / 2));
@@ -158,6 +165,10 @@ async function readParamDict(url: string): Promise<ParamDict> {
     const metadata = JSON.parse(
         String.fromCharCode.apply(null, bytes.slice(4, 4 + metadataSize)),
     );
+    if (!Array.isArray(metadata)) {
+        // Version 2 files carry diffusion or model configs we do not apply.
+        throw new Error(`unsupported weight file format: ${url}`);
+    }
 
     let allData = new Float32Array(flipToLittleEndian(buf.slice(4 + metadataSize)));
     const stateDict = {} as ParamDict;